@@ -0,0 +1,49 @@
+# this is the template that alembic is going to use to create our migration
+
+"""add rating aggregates to books
+
+Revision ID: 3e8b5c0f7a19
+Revises: 7c1f3a9d2e64
+Create Date: 2026-10-17 10:02:17.318846
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3e8b5c0f7a19'
+down_revision: Union[str, None] = '7c1f3a9d2e64'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('books', sa.Column('review_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('books', sa.Column('rating_sum', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('books', sa.Column('average_rating', sa.Float(), server_default='0', nullable=False))
+    # filling the new columns for the reviews that already exist
+    op.execute(
+        """
+        UPDATE books SET
+            review_count = stats.review_count,
+            rating_sum = stats.rating_sum,
+            average_rating = stats.rating_sum::float / stats.review_count
+        FROM (
+            SELECT book_uid, count(*) AS review_count, sum(rating) AS rating_sum
+            FROM reviews WHERE book_uid IS NOT NULL GROUP BY book_uid
+        ) AS stats
+        WHERE books.uid = stats.book_uid
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('books', 'average_rating')
+    op.drop_column('books', 'rating_sum')
+    op.drop_column('books', 'review_count')
@@ -0,0 +1,45 @@
+# this is the template that alembic is going to use to create our migration
+
+"""add book list sort indexes
+
+Revision ID: 5a0c8e3f9d21
+Revises: e2b9d4f7a163
+Create Date: 2026-10-17 17:18:52.904316
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5a0c8e3f9d21'
+down_revision: Union[str, None] = 'e2b9d4f7a163'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# every sort of the book lists has an index in its own order(the created_at one was added in 7c1f3a9d2e64)
+# so a page is read in order straight from the index and the scan stops after limit rows
+# language and author are equality filters, with them first the index also gives the newest books of one language or author in order
+# the other filters(published_date range, min_rating) can use the index of their own sort
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('ix_books_published_date_uid', 'books', [sa.text('published_date DESC'), sa.text('uid DESC')], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_books_title_uid', 'books', ['title', 'uid'], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_books_average_rating_uid', 'books', [sa.text('average_rating DESC'), sa.text('uid DESC')], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_books_language_created_at_uid', 'books', ['language', sa.text('created_at DESC'), sa.text('uid DESC')], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_books_author_created_at_uid', 'books', ['author', sa.text('created_at DESC'), sa.text('uid DESC')], postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_books_author_created_at_uid', table_name='books', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_books_language_created_at_uid', table_name='books', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_books_average_rating_uid', table_name='books', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_books_title_uid', table_name='books', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_books_published_date_uid', table_name='books', postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,49 @@
+# this is the template that alembic is going to use to create our migration
+
+"""add lookup indexes
+
+Revision ID: 7c1f3a9d2e64
+Revises: dbb882111e3f
+Create Date: 2026-10-17 09:12:41.502318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c1f3a9d2e64'
+down_revision: Union[str, None] = 'dbb882111e3f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# CREATE INDEX CONCURRENTLY builds the index without locking the table against writes, so this can run on a live db
+# postgres does not allow it inside a transaction, that's why every statement runs in an autocommit block
+# if a concurrent build fails it leaves an INVALID index behind, drop it and run the migration again
+# the unique indexes fail if there are already duplicate emails or tag names, those rows must be cleaned up first
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_email', 'users', ['email'], unique=True, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_tags_name', 'tags', ['name'], unique=True, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_books_created_at_uid', 'books', [sa.text('created_at DESC'), sa.text('uid DESC')], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_books_user_uid_created_at_uid', 'books', ['user_uid', sa.text('created_at DESC'), sa.text('uid DESC')], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_reviews_book_uid', 'reviews', ['book_uid'], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_reviews_user_uid', 'reviews', ['user_uid'], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_booktag_tag_id', 'booktag', ['tag_id'], postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_booktag_tag_id', table_name='booktag', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_reviews_user_uid', table_name='reviews', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_reviews_book_uid', table_name='reviews', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_books_user_uid_created_at_uid', table_name='books', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_books_created_at_uid', table_name='books', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_tags_name', table_name='tags', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_users_email', table_name='users', postgresql_concurrently=True, if_exists=True)
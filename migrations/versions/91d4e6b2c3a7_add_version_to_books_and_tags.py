@@ -0,0 +1,33 @@
+# this is the template that alembic is going to use to create our migration
+
+"""add version to books and tags
+
+Revision ID: 91d4e6b2c3a7
+Revises: 3e8b5c0f7a19
+Create Date: 2026-10-17 11:26:54.118203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '91d4e6b2c3a7'
+down_revision: Union[str, None] = '3e8b5c0f7a19'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('books', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('tags', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('tags', 'version')
+    op.drop_column('books', 'version')
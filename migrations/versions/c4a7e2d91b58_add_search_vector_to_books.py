@@ -0,0 +1,46 @@
+# this is the template that alembic is going to use to create our migration
+
+"""add search vector to books
+
+Revision ID: c4a7e2d91b58
+Revises: 91d4e6b2c3a7
+Create Date: 2026-10-17 14:03:27.641820
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4a7e2d91b58'
+down_revision: Union[str, None] = '91d4e6b2c3a7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# search_vector is computed by postgres from the title, author and publisher whenever a book is inserted or updated
+# a match in the title(weight A) ranks higher than a match in the author(B) or the publisher(C)
+# adding a stored generated column rewrites the whole books table and locks it while doing so, so run this when the traffic is low
+# the GIN index is what makes the @@ search fast, it is built concurrently like the other indexes
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(author, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(publisher, '')), 'C')"
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('books', sa.Column('search_vector', sa.dialects.postgresql.TSVECTOR(), sa.Computed(SEARCH_VECTOR, persisted=True)))
+    with op.get_context().autocommit_block():
+        op.create_index('ix_books_search_vector', 'books', ['search_vector'], postgresql_using='gin', postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_books_search_vector', table_name='books', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('books', 'search_vector')
@@ -0,0 +1,40 @@
+# this is the template that alembic is going to use to create our migration
+
+"""add trigram indexes
+
+Revision ID: e2b9d4f7a163
+Revises: c4a7e2d91b58
+Create Date: 2026-10-17 15:41:09.327514
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2b9d4f7a163'
+down_revision: Union[str, None] = 'c4a7e2d91b58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# pg_trgm splits text into groups of three letters(trigrams). a GIN index over them can answer ILIKE 'x%' and the similarity operators(<%)
+# that the suggest endpoints use, without reading every row. creating the extension needs a user that is allowed to do it
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    with op.get_context().autocommit_block():
+        op.create_index('ix_books_title_trgm', 'books', ['title'], postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'}, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_books_author_trgm', 'books', ['author'], postgresql_using='gin', postgresql_ops={'author': 'gin_trgm_ops'}, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_tags_name_trgm', 'tags', ['name'], postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}, postgresql_concurrently=True, if_not_exists=True)
+
+
+# the extension is left in place, other things in the db may be using it
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_tags_name_trgm', table_name='tags', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_books_author_trgm', table_name='books', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_books_title_trgm', table_name='books', postgresql_concurrently=True, if_exists=True)
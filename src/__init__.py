@@ -6,7 +6,10 @@ from src.tags.routes import tags_router
 from contextlib import asynccontextmanager
 from src.db.main import init_db
 from .errors import register_all_errors
-from .middleware import register_middleware
+from .middleware import register_middleware, start_access_log, stop_access_log
+from .metrics import metrics_router, mark_process_dead
+from .outbox import mail_outbox
+from .db.redis import revoked_tokens, init_redis, close_redis, migrate_legacy_blocklist
 
 
 # we use this decorator to determine which code would be run at the start of our app and which at the end of our app
@@ -22,9 +25,19 @@ async def life_span(app: FastAPI):
         # we are using lifespan event to make modification to our db
         # every time we create a table the lifespan event will run and create that table in our db
         # since we are using alembic now, server lifespan event is not needed anymore( init_db() is not needed anymore )
+    start_access_log() # starting the thread that writes our access log
+    await init_redis() # the redis client and its connection pool live as long as the app
+    await migrate_legacy_blocklist() # copies the revoked tokens of the previous release into the sorted set, only the first start does it
+    await mail_outbox.start()
+    revoked_tokens.start() # keeping the local copy of the token blocklist in sync with redis
 
     yield
     print("server is shutting down...")
+    await revoked_tokens.stop()
+    await mail_outbox.stop()
+    await close_redis()
+    stop_access_log()
+    mark_process_dead() # the gauges of this worker must not be counted after it's gone
 
 
 version = "v1"
@@ -49,3 +62,4 @@ app.include_router(book_router, prefix=f"/api/{version}/books", tags=["books"])
 app.include_router(auth_router, prefix=f"/api/{version}/auth", tags=["users"])
 app.include_router(review_router, prefix=f"/api/{version}/reviews", tags=["reviews"])
 app.include_router(tags_router, prefix=f"/api/{version}/tags", tags=["tags"])
+app.include_router(metrics_router, tags=["metrics"])
@@ -8,7 +8,7 @@ from sqlmodel.ext.asyncio.session import AsyncSession
 from src.db.main import get_session
 from .service import UserService
 from typing import List # to be more verbose and more specific we can use List from typing
-from src.db.models import User
+from .schemas import UserPrincipal
 from src.errors import (
     InvalidToken, RefreshTokenRequired, AccessTokenRequired, InvalidToken, InsufficientPermission, AccountNotVerified
 )
@@ -45,9 +45,10 @@ class TokenBearer(HTTPBearer):
         # let's authorize our users(check if our user is valid and providing a valid access token)
 
         token = creds.credentials
-        token_data = decode_token(token)
+        token_data = decode_token(token)  # this function returns None if our token is not valid
 
-        if not self.token_valid(token):
+        # we decode the token only once. verifying the signature is the expensive part so we don't want to do it twice
+        if token_data is None:
             raise InvalidToken()
 
         # here we check if the token is in the blocklist
@@ -59,12 +60,6 @@ class TokenBearer(HTTPBearer):
         # instead of returning the token we will return the token data
         return token_data
 
-    # now that we have access to our token we must decode it and find out whether it's valid or not
-    def token_valid(self, token: str) -> bool:
-        token_data = decode_token(token)  # this function returns None if our token is not valid
-        # return True if token_data is not None else False
-        return token_data is not None
-
     # this is a method that is accessed by the parent class but the other classes verify_token_data methods are going to override it
     # but in case they are not implemented we would raise NotImplementedError function meaning that if it failed to override, then throw that error and do what it says
     def verify_token_data(self, token_data):
@@ -92,17 +87,41 @@ class RefreshTokenBearer(TokenBearer):
             raise RefreshTokenRequired()
 
 
-# this is a dependency which gets the current logged in user
-# this is going to take the token that is provided via the authorization headers
+# fastapi caches the result of a dependency for the duration of a request, but only if it is the same dependency(the same obj)
+# two AccessTokenBearer() objects are two different dependencies, so the token would be checked once for each of them
+# that's why every route and dependency that needs the access token must use this one obj
+access_token_bearer = AccessTokenBearer()
+
+
+# this class holds everything we know about the authenticated request: the decoded token and the user it belongs to
+class AuthContext:
+    def __init__(self, token_data: dict, user: UserPrincipal) -> None:
+        self.token_data = token_data
+        self.user = user
+
+
+# this is the dependency that authenticates a request
+# the token is decoded and checked against the blocklist once(by access_token_bearer) and the user is looked up once
+# the user is usually served from user_cache, so in most requests authorization doesn't touch the db at all
+# RoleChecker, get_current_user and the route handlers all receive the same AuthContext within a request
 # we can inject into a dependency as many dependencies as we want but the problem is we must do in for only dependencies that we are going to use within routes
 # if we inject a dependency into a class or a function that we are using outside routes that's not going to work
-# here we inject session dependency to this class
-# any checks for the token will be done by this dependency
-async def get_current_user(token_details: dict = Depends(AccessTokenBearer()), session: AsyncSession = Depends(get_session)): # token_details is an obj of AccessTokenBearer class and is provided as a dependency in this function which will be used in our route handler
+async def get_auth_context(request: Request, token_details: dict = Depends(access_token_bearer), session: AsyncSession = Depends(get_session)) -> AuthContext:
     # here we get the user email and use that email to get that user from our db
     user_email = token_details["user"]["email"]
-    user = await user_service.get_user_by_email(user_email, session)
-    return user
+    user = await user_service.get_user_principal(user_email, session)
+    if user is None: # the token belongs to a user who does not exist anymore
+        raise InvalidToken()
+
+    auth = AuthContext(token_data=token_details, user=user)
+    request.state.auth = auth # so the middleware can see who made the request
+    return auth
+
+
+# this is a dependency which gets the current logged in user
+# any checks for the token will be done by get_auth_context
+async def get_current_user(auth: AuthContext = Depends(get_auth_context)):
+    return auth.user
 
 
 # this class is RoleChecker dependency
@@ -112,7 +131,7 @@ class RoleChecker:
     def __init__(self, allowed_roles: List[str]) -> None: # each obj we make from this class is going to take in a list of roles
         self.allowed_roles = allowed_roles
 
-    def __call__(self, current_user: User = Depends(get_current_user)):
+    def __call__(self, current_user: UserPrincipal = Depends(get_current_user)):
         if not current_user.is_verified: # this means if the user is_verified field is False then raise an error since they are not allowed to do anything
             raise AccountNotVerified()
         if not current_user.role in self.allowed_roles: # checking if a role has been provided to the endpoint
@@ -1,21 +1,20 @@
 from fastapi import APIRouter, Depends, status, HTTPException, BackgroundTasks
 from sqlmodel.ext.asyncio.session import AsyncSession
-from .service import UserService
+from .service import UserService, USER_PROFILE_RELATIONSHIPS
 from ..db.main import get_session
 from datetime import timedelta, datetime
 from fastapi.responses import JSONResponse
-from .dependecies import RefreshTokenBearer, AccessTokenBearer, get_current_user, RoleChecker
+from .dependecies import RefreshTokenBearer, access_token_bearer, get_current_user, RoleChecker
 from src.db.redis import add_jti_to_blocklist
-from src.errors import UserAlreadyExist, InvalidCredentials, InvalidToken, UserNotFound
-from src.mail import mail, create_message
-from src.celery_tasks import send_email # bringing send_email task from the respective file
+from src.errors import UserAlreadyExist, InvalidCredentials, InvalidToken, UserNotFound, MailJobNotFound
+from src.outbox import mail_outbox
 from src.config import Config
 from .utils import (
     create_access_token,
-    verify_passwd_hash,
+    verify_passwd_hash_async,
     create_url_safe_token,
     decode_url_safe_token,
-    generate_passwd_hash
+    generate_passwd_hash_async
 )
 
 from .schemas import (
@@ -24,7 +23,8 @@ from .schemas import (
     UserBooksModel,
     EmailModel,
     PasswordResetRequestModel,
-    PasswordResetConfirmModel
+    PasswordResetConfirmModel,
+    MailJobStatusModel
 )
 
 auth_router = APIRouter()
@@ -34,19 +34,29 @@ role_checker = RoleChecker(["admin", "user"])
 REFRESH_TOKEN_EXPIRY = 2
 
 # with this endpoint we would send emails
+# the list of addresses can be very long, so it is split into chunks that the celery workers send in parallel(see MailOutbox.send_bulk)
+# the job_id of the response can be used to follow the progress at /send_mail/{job_id}
 @auth_router.post("/send_mail")
 async def send_mail(emails: EmailModel):
     emails = emails.addresses
     subject = "FastAPI"
-    html = "<h1>Welcome to the app</h1>"
 
-    send_email.delay(emails, subject, html) # delay method means this function is a celery task
+    job_id = await mail_outbox.send_bulk(emails, subject, "welcome") # the outbox sends it in the background(see src/outbox.py)
 
     # message = create_message(recipients=emails, subject=subject, body=html) # this line returns a message schema
     #
     # await mail.send_message(message)
 
-    return {"message": "email sent successfully"}
+    return {"message": "email sent successfully", "job_id": job_id}
+
+
+# this endpoint shows how far a bulk email of /send_mail has got
+@auth_router.get("/send_mail/{job_id}", response_model=MailJobStatusModel)
+async def get_send_mail_status(job_id: str):
+    job_status = await mail_outbox.bulk_status(job_id)
+    if job_status is None:
+        raise MailJobNotFound()
+    return job_status
 
 
 
@@ -64,16 +74,12 @@ async def create_user_account(user_data: UserCreateModel, bg_tasks: BackgroundTa
 
     link = f"http://{Config.DOMAIN}/api/v1/auth/verify/{token}"
 
-    html_message = f"""
-    <h1>Verify your Email</h1>
-    <p>please click this <a href="{link}">link</a> to verify your email</p>
-    """
-
     subject = "Verify your Email"
 
     emails = [email] # in celery we should give the email as a list
 
-    send_email.delay(emails, subject, html_message)  # delay method means this function is a celery task
+    # the html of the email is in src/templates/email/verify_email.html
+    await mail_outbox.send(emails, subject, "verify_email", {"link": link})
 
 
 
@@ -128,7 +134,7 @@ async def login_user(login_data: UserLoginModel, session: AsyncSession = Depends
     password = login_data.password
     user = await user_service.get_user_by_email(email, session)
     if user is not None:
-        password_valid = verify_passwd_hash(password, user.password_hash)  # the output would be True or False
+        password_valid = await verify_passwd_hash_async(password, user.password_hash)  # the output would be True or False
         if password_valid:  # if password is correct    then we will create both access token and refresh token for the user
             access_token = create_access_token(
                 user_data={
@@ -180,17 +186,19 @@ async def get_new_access_token(token_datails: dict = Depends(RefreshTokenBearer(
 
 
 # this path returns the current user
+# the books and reviews of the user are not loaded by get_current_user, so we load them here
 @auth_router.get("/me", dependencies=[Depends(role_checker)], response_model=UserBooksModel)
-async def get_current_user(user = Depends(get_current_user)):
+async def get_current_user(user = Depends(get_current_user), session: AsyncSession = Depends(get_session)):
+    user = await user_service.get_user_by_email(user.email, session, load=USER_PROFILE_RELATIONSHIPS)
     return user
 
 
 # this endpoint is used for revoking the tokenx
 @auth_router.get("/logout")
-async def revoke_token(token_details: dict = Depends(AccessTokenBearer())): # since we want access token details, we must use AccessTokenBearer dependency
+async def revoke_token(token_details: dict = Depends(access_token_bearer)): # since we want access token details, we must use the access_token_bearer dependency
     jti = token_details["jti"]
-    # now that we have the jti we will add it to the token_blocklist
-    await add_jti_to_blocklist(jti)
+    # now that we have the jti we will add it to the token_blocklist, until the token would have expired anyway
+    await add_jti_to_blocklist(jti, token_details["exp"])
 
     return JSONResponse(content={
         "massage": "logout successful",
@@ -205,16 +213,11 @@ async def password_reset_request(email_data: PasswordResetRequestModel):
     token = create_url_safe_token({"email": email})
     link = f"http://{Config.DOMAIN}/api/v1/auth/password-reset-confirm/{token}"
 
-    html_message = f"""
-    <h1>Reset your password</h1>
-    <p>please click this <a href="{link}">link</a> to Reset your Password</p>
-    """
-
     subject = "Reset your password"
 
-    message = create_message(recipients=[email], subject=subject, body=html_message) # this line returns a message schema
-
-    await mail.send_message(message)
+    # sending the email used to make the response wait for the mail server, now the outbox sends it in the background
+    # asking again within MAIL_DEDUP_WINDOW seconds doesn't send another email, the link of the first one still works
+    await mail_outbox.send([email], subject, "password_reset", {"link": link}, dedup_key=f"password-reset:{email.lower()}")
     return JSONResponse(
         content={
             "message": "password reset link sent! please check your email for more details",
@@ -234,7 +237,7 @@ async def reset_account_password(token: str, passwords: PasswordResetConfirmMode
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="passwords don't match")
 
     # here we hash the new password
-    password_hash = generate_passwd_hash(new_password)
+    password_hash = await generate_passwd_hash_async(new_password)
 
     token_data = decode_url_safe_token(token) # here we encrypt user email so it wouldn't be shown in the url
 
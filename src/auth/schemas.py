@@ -25,6 +25,14 @@ class UserModel(BaseModel):
     created_at: datetime
     updated_at: datetime
 
+# this is the small version of a user that we need to authorize requests. it is what get_current_user returns
+class UserPrincipal(BaseModel):
+    uid: uuid.UUID
+    email: str
+    role: str
+    is_verified: bool
+
+
 class UserBooksModel(UserModel):
     books: List[Book]
     reviews: List[ReviewModel]
@@ -39,6 +47,16 @@ class EmailModel(BaseModel):
     addresses: List[str]
 
 
+# the progress of a bulk email, the recipients are sent in chunks(see MailOutbox.send_bulk)
+class MailJobStatusModel(BaseModel):
+    job_id: str
+    chunks: int
+    completed_chunks: int
+    failed_chunks: int
+    sent: int # recipients the email has been sent to so far
+    done: bool
+
+
 class PasswordResetRequestModel(BaseModel):
     email: str
 
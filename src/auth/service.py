@@ -1,18 +1,48 @@
 from src.db.models import User
-from .schemas import UserCreateModel
+from src.db.loaders import with_relationships
+from .schemas import UserCreateModel, UserPrincipal
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel import select
-from .utils import generate_passwd_hash
+from .utils import generate_passwd_hash_async
+from src.cache import TTLLRUCache
+from src.config import Config
+
+# authenticated users by email. this cache lets us authorize requests without going to the db every time
+user_cache = TTLLRUCache(max_size=Config.USER_CACHE_MAX_SIZE, ttl=Config.USER_CACHE_TTL)
+
+# when one of these fields of a user changes, the cached version of that user is not valid anymore
+CACHED_USER_FIELDS = {"is_verified", "role", "password_hash"}
+
+
+# the relationships that the /me endpoint returns alongside the user
+USER_PROFILE_RELATIONSHIPS = (User.books, User.reviews)
 
 
 class UserService:
-    async def get_user_by_email(self, email: str, session: AsyncSession): # this function is going to get the user by its email
-        statement = select(User).where(User.email == email)
+    async def get_user_by_email(self, email: str, session: AsyncSession, load=()): # this function is going to get the user by its email
+        statement = with_relationships(select(User).where(User.email == email), load)
 
         result = await session.exec(statement)
         user = result.first()
         return user
 
+    # this function returns the UserPrincipal of the user with the given email, from the cache if it's there
+    # on a miss we only select the four columns we need instead of the whole user row
+    async def get_user_principal(self, email: str, session: AsyncSession) -> UserPrincipal | None:
+        principal = user_cache.get(email)
+        if principal is not None:
+            return principal
+
+        statement = select(User.uid, User.email, User.role, User.is_verified).where(User.email == email)
+        result = await session.exec(statement)
+        row = result.first()
+        if row is None:
+            return None
+
+        principal = UserPrincipal(uid=row.uid, email=row.email, role=row.role, is_verified=row.is_verified)
+        user_cache.set(email, principal)
+        return principal
+
     async def user_exists(self, email: str, session: AsyncSession) -> bool: # this function allow us to check if the user exists or not
         user = await self.get_user_by_email(email, session)
 
@@ -23,7 +53,7 @@ class UserService:
         new_user = User(**user_data_dict) # in this line we craete a new user obj
 
         # the next two fields are fields that we have modified f or our users
-        new_user.password_hash = generate_passwd_hash(user_data_dict.get("password"))
+        new_user.password_hash = await generate_passwd_hash_async(user_data_dict.get("password"))
         new_user.role = "user" # we set default role value to users
 
         session.add(new_user)
@@ -38,4 +68,7 @@ class UserService:
             setattr(user, k, v)
 
         await session.commit()
+
+        if CACHED_USER_FIELDS & user_data.keys():
+            user_cache.invalidate(user.email)
         return user
@@ -5,7 +5,10 @@ from src.config import Config
 import jwt
 import uuid
 import logging
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from itsdangerous import URLSafeTimedSerializer
+from src.metrics import PASSWORD_HASH_DURATION, PASSWORD_HASH_QUEUED
 
 # URLSafeTimedSerializer takes in a str and then creates a token into it, and we can set the time the data has been signed
 # for example we create a token and we want to check if it has been signed and how much it has been passed around, in that case we can use this module
@@ -26,6 +29,61 @@ def verify_passwd_hash(password: str, hashed_password: str) -> bool:
     return passwd_context.verify(password, hashed_password)
 
 
+# bcrypt is slow on purpose, one hash takes tens to hundreds of milliseconds
+# if we call the functions above inside an async route handler, the event loop is blocked for that long and every other request of this worker waits
+# so route handlers must use the async versions below, which run bcrypt in a thread pool. bcrypt releases the GIL while hashing so these threads really run in parallel
+# the semaphore limits how many hashes are running at once, the others wait for their turn without blocking the event loop
+class PasswordHashStats:
+    def __init__(self) -> None:
+        self.queued = 0 # requests that are waiting for a free hashing slot right now
+        self.running = 0
+        self.completed = 0
+
+
+passwd_hash_stats = PasswordHashStats()
+passwd_executor = ThreadPoolExecutor(max_workers=Config.PASSWORD_HASH_WORKERS, thread_name_prefix="passwd-hash")
+passwd_slots = asyncio.Semaphore(Config.PASSWORD_HASH_WORKERS)
+
+
+# operation is the name of the hashing operation in our metrics
+def timed_passwd_func(func, operation: str):
+    def timed(*args):
+        with PASSWORD_HASH_DURATION.labels(operation).time():
+            return func(*args)
+    return timed
+
+
+timed_generate_passwd_hash = timed_passwd_func(generate_passwd_hash, "hash")
+timed_verify_passwd_hash = timed_passwd_func(verify_passwd_hash, "verify")
+
+
+async def run_in_passwd_executor(func, *args):
+    passwd_hash_stats.queued += 1
+    PASSWORD_HASH_QUEUED.inc()
+    try:
+        await passwd_slots.acquire()
+    finally:
+        passwd_hash_stats.queued -= 1
+        PASSWORD_HASH_QUEUED.dec()
+
+    passwd_hash_stats.running += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(passwd_executor, func, *args)
+    finally:
+        passwd_hash_stats.running -= 1
+        passwd_hash_stats.completed += 1
+        passwd_slots.release()
+
+
+async def generate_passwd_hash_async(password: str) -> str:
+    return await run_in_passwd_executor(timed_generate_passwd_hash, password)
+
+
+async def verify_passwd_hash_async(password: str, hashed_password: str) -> bool:
+    return await run_in_passwd_executor(timed_verify_passwd_hash, password, hashed_password)
+
+
 # JWT
 
 ACCESS_TOKEN_EXPIRY = 3600  # token would be valid for 3600 seconds and after 3600 seconds, the user has to enter the system again or sends refresh token to take another token
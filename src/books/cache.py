@@ -0,0 +1,149 @@
+# this file has the redis cache of the book endpoints
+# we keep the serialized json of the book detail and of the first page of the book lists, so popular books are not loaded from the db on every request
+#
+# instead of deleting cached entries when data changes, every entry has version numbers in its key
+# a write just increments the version(INCR), and from then on requests look for a key that does not exist yet and load fresh data
+# the old entries are never read again and expire on their own after their TTL
+#
+# every call to redis goes through the circuit breaker(see src/db/redis.py), while it's open the cache is skipped right away
+#
+# when an entry is missing, only one request loads it from the db (single-flight). inside a worker the others await the same future
+# and between workers a short redis lock makes the others wait for the key to be stored instead of all going to the db at once
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+from redis.exceptions import RedisError
+from src.db.redis import get_redis, redis_breaker
+from src.config import Config
+
+BOOK_LIST_VERSION_KEY = "books:list:version" # changes when any book is created, updated or deleted
+TAGS_VERSION_KEY = "tags:version" # changes when a tag is renamed or deleted, since that changes the detail of every book with that tag
+
+Loader = Callable[[], Awaitable[str | bytes | None]]
+
+
+def book_version_key(book_uid) -> str:
+    return f"book:{book_uid}:version"
+
+
+class BookCache:
+    def __init__(self) -> None:
+        self._loading: dict[str, asyncio.Future] = {}
+
+    # etag is the one the route computed from the version the db has right now. it is part of the key so a payload
+    # cached from an older row is never served under the etag of a newer one
+    async def get_book_detail(self, book_uid, etag: str, loader: Loader) -> str | bytes | None:
+        if not Config.BOOK_CACHE_ENABLED:
+            return await loader()
+        try:
+            book_version, tags_version = await self._versions(book_version_key(book_uid), TAGS_VERSION_KEY)
+        except RedisError as e:
+            logging.warning("book cache is not available: %s", e)
+            return await loader()
+        key = f"book:{book_uid}:detail:{etag}:{book_version}:{tags_version}"
+        return await self._get_or_load(key, loader, Config.BOOK_CACHE_DETAIL_TTL)
+
+    # list_name tells lists apart, for example "all" or "user:<user_uid>"
+    async def get_book_list(self, list_name: str, limit: int, loader: Loader) -> str | bytes | None:
+        if not Config.BOOK_CACHE_ENABLED:
+            return await loader()
+        try:
+            (list_version,) = await self._versions(BOOK_LIST_VERSION_KEY)
+        except RedisError as e:
+            logging.warning("book cache is not available: %s", e)
+            return await loader()
+        key = f"books:list:{list_name}:{limit}:{list_version}"
+        return await self._get_or_load(key, loader, Config.BOOK_CACHE_LIST_TTL)
+
+    # these functions are called after a write has been committed
+    # a failure to reach redis must not fail the write itself, so we only log it
+    async def invalidate_books(self, *book_uids) -> None:
+        await self._bump(BOOK_LIST_VERSION_KEY, *(book_version_key(book_uid) for book_uid in book_uids))
+
+    async def invalidate_tags(self) -> None:
+        await self._bump(TAGS_VERSION_KEY)
+
+    async def _bump(self, *version_keys) -> None:
+        if not Config.BOOK_CACHE_ENABLED:
+            return
+        try:
+            async with redis_breaker, get_redis().pipeline(transaction=False) as pipe:
+                for version_key in version_keys:
+                    pipe.incr(version_key)
+                await pipe.execute()
+        except RedisError as e:
+            logging.warning("could not invalidate the book cache: %s", e)
+
+    async def _versions(self, *version_keys) -> list[int]:
+        async with redis_breaker:
+            values = await get_redis().mget(version_keys)
+        return [int(value) if value is not None else 0 for value in values]
+
+    async def _get_or_load(self, key: str, loader: Loader, ttl: int) -> str | bytes | None:
+        try:
+            async with redis_breaker:
+                payload = await get_redis().get(key)
+        except RedisError as e:
+            logging.warning("book cache is not available: %s", e)
+            return await loader()
+        if payload is not None:
+            return payload
+
+        # another request of this worker is already loading this key, we wait for its result
+        loading = self._loading.get(key)
+        if loading is not None:
+            try:
+                # shield keeps the shared future alive if this request gets cancelled
+                return await asyncio.shield(loading)
+            except asyncio.CancelledError:
+                if loading.cancelled(): # the request that was loading it has failed, so we load it ourselves
+                    return await loader()
+                raise
+
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[key] = loading
+        try:
+            payload = await self._load(key, loader, ttl)
+        except BaseException:
+            loading.cancel()
+            raise
+        else:
+            loading.set_result(payload)
+            return payload
+        finally:
+            del self._loading[key]
+
+    async def _load(self, key: str, loader: Loader, ttl: int) -> str | bytes | None:
+        lock_key = f"{key}:lock"
+        try:
+            # NX means the key is only set if it doesn't exist, so only one worker gets the lock
+            # px expires the lock in case the worker holding it dies
+            async with redis_breaker:
+                has_lock = await get_redis().set(lock_key, "1", nx=True, px=int(Config.BOOK_CACHE_LOCK_TIMEOUT * 1000))
+            if not has_lock:
+                # another worker is loading this key, we wait for it to be stored
+                deadline = time.monotonic() + Config.BOOK_CACHE_LOCK_TIMEOUT
+                while time.monotonic() < deadline:
+                    await asyncio.sleep(0.05)
+                    async with redis_breaker:
+                        payload = await get_redis().get(key)
+                    if payload is not None:
+                        return payload
+        except RedisError as e:
+            logging.warning("book cache is not available: %s", e)
+            has_lock = False
+
+        payload = await loader()
+        try:
+            async with redis_breaker:
+                if payload is not None:
+                    await get_redis().set(key, payload, ex=ttl)
+                if has_lock:
+                    await get_redis().delete(lock_key)
+        except RedisError as e:
+            logging.warning("could not store %s in the book cache: %s", key, e)
+        return payload
+
+
+book_cache = BookCache()
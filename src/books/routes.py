@@ -1,11 +1,17 @@
-from fastapi import APIRouter, status, HTTPException, Depends
+from fastapi import APIRouter, status, HTTPException, Depends, Query, Request
+from fastapi.responses import Response, StreamingResponse
 from sqlmodel.ext.asyncio.session import AsyncSession
-from typing import List
-from .schemas import Book, BookUpdateModel, BookCreateModel, BookDetailModel
-from src.db.main import get_session
-from .service import BookService
-from src.auth.dependecies import AccessTokenBearer, RoleChecker
-from src.errors import BookNotFound
+from typing import Annotated, List, Literal, Optional
+from datetime import datetime
+from .schemas import Book, BookUpdateModel, BookCreateModel, BookDetailModel, BookPageModel, BookImportResult, BookSuggestionModel, BookListParams
+from src.db.main import get_session, async_session_factory
+from .service import BookService, BOOK_DETAIL_RELATIONSHIPS, book_etag
+from .cache import book_cache
+from .utils import iter_ndjson_rows, iter_csv_rows, ndjson_chunk, csv_chunk, csv_header
+from src.auth.dependecies import access_token_bearer, RoleChecker
+from src.errors import BookNotFound, UnsupportedMediaType
+from src.config import Config
+from src.etag import not_modified, check_if_match
 
 
 
@@ -13,7 +19,6 @@ from src.errors import BookNotFound
 
 book_router = APIRouter()
 book_service = BookService()
-access_token_bearer = AccessTokenBearer()
 role_checker = RoleChecker(["admin", "user"])
 
 
@@ -25,16 +30,39 @@ role_checker = RoleChecker(["admin", "user"])
 
 
 # this endpoint is made to get all the books from our server
-@book_router.get('/', response_model = List[Book], dependencies=[Depends(role_checker)])
-async def get_all_books(session: AsyncSession = Depends(get_session), token_details: dict = Depends(access_token_bearer)):
-    books = await book_service.get_all_books(session)
-    return books
+# books are returned page by page. to get the next page, the client sends back the next_cursor it has received as the cursor
+# the filters and the sort are query parameters too(see BookListParams), and the cursor must be sent with the same ones
+@book_router.get('/', response_model = BookPageModel, dependencies=[Depends(role_checker)])
+async def get_all_books(params: Annotated[BookListParams, Query()],
+                        session: AsyncSession = Depends(get_session), token_details: dict = Depends(access_token_bearer)):
+    # only the first page of the unfiltered lists is cached, the next pages and the filtered lists are read much less often
+    if params.cursor is not None or params.has_filters():
+        books = await book_service.get_all_books(session, params.limit, params.cursor, params)
+        return books
+
+    async def load_page():
+        books = await book_service.get_all_books(session, params.limit, filters=params)
+        return BookPageModel.model_validate(books, from_attributes=True).model_dump_json()
+
+    # the cache holds the json of the response, so we send it as it is instead of validating it again
+    payload = await book_cache.get_book_list(f"all:{params.sort}", params.limit, load_page)
+    return Response(content=payload, media_type="application/json")
 
 # this endpoint returns all the book from a certain user which we specify by user_uid
-@book_router.get('/user/{user_uid}', response_model = List[Book], dependencies=[Depends(role_checker)])
-async def get_user_book_submissions(user_uid: str, session: AsyncSession = Depends(get_session), token_details: dict = Depends(access_token_bearer)):
-    books = await book_service.get_user_books(user_uid, session)
-    return books
+@book_router.get('/user/{user_uid}', response_model = BookPageModel, dependencies=[Depends(role_checker)])
+async def get_user_book_submissions(user_uid: str,
+                                    params: Annotated[BookListParams, Query()],
+                                    session: AsyncSession = Depends(get_session), token_details: dict = Depends(access_token_bearer)):
+    if params.cursor is not None or params.has_filters():
+        books = await book_service.get_user_books(user_uid, session, params.limit, params.cursor, params)
+        return books
+
+    async def load_page():
+        books = await book_service.get_user_books(user_uid, session, params.limit, filters=params)
+        return BookPageModel.model_validate(books, from_attributes=True).model_dump_json()
+
+    payload = await book_cache.get_book_list(f"user:{user_uid}:{params.sort}", params.limit, load_page)
+    return Response(content=payload, media_type="application/json")
 
 
 # this endpoint is made to create a new book on our server
@@ -46,22 +74,112 @@ async def create_a_book(book_data: BookCreateModel, session: AsyncSession = Depe
 
 
 
+# this endpoint imports many books at once from a file sent as the body, one book per line(ndjson) or per row(csv, with a header row)
+# the body is read as a stream and the books are inserted while it's still arriving
+# rows that are not valid are skipped and reported back with their row number
+# it must be declared before the /{book_uid} routes, otherwise "bulk" would be taken as a book_uid
+@book_router.post('/bulk', response_model=BookImportResult, dependencies=[Depends(role_checker)])
+async def import_books(request: Request, session: AsyncSession = Depends(get_session), token_details: dict = Depends(access_token_bearer)) -> dict:
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type in ("application/x-ndjson", "application/jsonl", "application/json"):
+        rows = iter_ndjson_rows(request.stream())
+    elif content_type == "text/csv":
+        rows = iter_csv_rows(request.stream())
+    else:
+        raise UnsupportedMediaType()
+
+    user_uid = token_details.get("user")["user_uid"]
+    return await book_service.import_books(rows, user_uid, session)
+
+
+# this endpoint searches the books by their title, author and publisher, the best matches come first
+# the results can be narrowed down to the books with a tag or in a language
+# it must be declared before the /{book_uid} routes, otherwise "search" would be taken as a book_uid
+@book_router.get('/search', response_model=BookPageModel, dependencies=[Depends(role_checker)])
+async def search_books(q: str = Query(min_length=1),
+                       tag: Optional[str] = None,
+                       language: Optional[str] = None,
+                       limit: int = Query(default=Config.BOOKS_PAGE_SIZE, ge=1, le=Config.BOOKS_MAX_PAGE_SIZE),
+                       cursor: Optional[str] = None,
+                       session: AsyncSession = Depends(get_session), token_details: dict = Depends(access_token_bearer)):
+    return await book_service.search_books(q, session, limit, cursor, tag=tag, language=language)
+
+
+# this endpoint suggests books while the user is typing their title or author
+# it must be declared before the /{book_uid} routes, otherwise "suggest" would be taken as a book_uid
+@book_router.get('/suggest', response_model=List[BookSuggestionModel], dependencies=[Depends(role_checker)])
+async def suggest_books(q: str = Query(min_length=1, max_length=100),
+                        limit: int = Query(default=Config.SUGGEST_LIMIT, ge=1, le=Config.SUGGEST_MAX_LIMIT),
+                        session: AsyncSession = Depends(get_session), token_details: dict = Depends(access_token_bearer)):
+    return await book_service.suggest_books(q, session, limit)
+
+
+# this endpoint sends the whole catalog(or the books of one user or of a time range) as a file, one book per line(ndjson) or per row(csv)
+# the books are read from the db and sent in batches, so neither the server nor the client has to hold all of them
+# it must be declared before the /{book_uid} routes, otherwise "export" would be taken as a book_uid
+@book_router.get('/export', dependencies=[Depends(role_checker)])
+async def export_books(format: Literal["ndjson", "csv"] = "ndjson",
+                       user_uid: Optional[str] = None,
+                       created_after: Optional[datetime] = None,
+                       created_before: Optional[datetime] = None,
+                       token_details: dict = Depends(access_token_bearer)):
+    columns = list(Book.model_fields)
+
+    # the body is sent after this function has returned and the session of get_session has already been closed by then
+    # so the stream opens its own session, which lives as long as the body is being sent
+    async def generate():
+        if format == "csv":
+            yield csv_header(Book)
+        async with async_session_factory() as session:
+            async for rows in book_service.stream_books(columns, session, user_uid, created_after, created_before):
+                yield ndjson_chunk(rows, Book) if format == "ndjson" else csv_chunk(rows, Book)
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    headers = {"Content-Disposition": f'attachment; filename="books.{format}"'}
+    return StreamingResponse(generate(), media_type=media_type, headers=headers)
+
+
 # this endpoint is made to fetch a book info by its id
 @book_router.get('/{book_uid}', response_model=BookDetailModel, dependencies=[Depends(role_checker)])
-async def get_book(book_uid: str, session: AsyncSession = Depends(get_session), token_details: dict = Depends(access_token_bearer)) -> dict:
-    book = await book_service.get_book(book_uid, session)
-    if book:
-       return book
-    else:
+async def get_book(book_uid: str, request: Request, session: AsyncSession = Depends(get_session), token_details: dict = Depends(access_token_bearer)) -> dict:
+    # first we only read the version of the book. if the client already has this version we answer 304 without loading anything else
+    current = await book_service.get_book_version(book_uid, session)
+    if current is None:
+        raise BookNotFound()
+    etag = book_etag(current)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+
+    async def load_book():
+        book = await book_service.get_book(book_uid, session, load=BOOK_DETAIL_RELATIONSHIPS)
+        if book is None:
+            return None
+        return BookDetailModel.model_validate(book, from_attributes=True).model_dump_json()
+
+    # the book is read from the redis cache, and loaded from the db only if it's not there
+    payload = await book_cache.get_book_detail(book_uid, etag, load_book)
+    if payload is None:
         raise BookNotFound()
+    return Response(content=payload, media_type="application/json", headers={"ETag": etag})
 
 
 
 # this endpoint is made to update a book information and by its id
 @book_router.patch('/{book_uid}', response_model=Book, dependencies=[Depends(role_checker)])
-async def update_book(book_uid: str, book_update_data: BookUpdateModel, session: AsyncSession = Depends(get_session), token_details: dict = Depends(access_token_bearer)) -> dict:
-    updated_book = await book_service.update_book(book_uid, book_update_data, session)
+# if the client sends If-Match with the ETag it has, the book is only updated if nobody has changed it since then
+async def update_book(book_uid: str, book_update_data: BookUpdateModel, request: Request, response: Response, session: AsyncSession = Depends(get_session), token_details: dict = Depends(access_token_bearer)) -> dict:
+    expected_version = None
+    if "if-match" in request.headers:
+        current = await book_service.get_book_version(book_uid, session)
+        if current is None:
+            raise BookNotFound()
+        check_if_match(request, book_etag(current))
+        expected_version = current.version
+
+    updated_book = await book_service.update_book(book_uid, book_update_data, session, expected_version=expected_version)
     if updated_book:
+        response.headers["ETag"] = book_etag(updated_book)
         return updated_book
     else:
         raise BookNotFound()
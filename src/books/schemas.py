@@ -1,9 +1,10 @@
 import uuid
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime, date
-from typing import List
+from typing import List, Literal, Optional
 from src.reviews.schemas import ReviewModel
 from src.tags.schemas import TagModel
+from src.config import Config
 
 
 class Book(BaseModel):
@@ -14,6 +15,8 @@ class Book(BaseModel):
     published_date: date
     page_count: int
     language: str
+    review_count: int
+    average_rating: float
     created_at: datetime
     updated_at: datetime
 
@@ -22,6 +25,39 @@ class BookDetailModel(Book):
     tags: List[TagModel]
 
 
+# the query parameters of the book lists, all the filters are optional
+# books must have at least one of the tags in tag(?tag=a&tag=b)
+# limit and cursor are here too because fastapi only reads a model from the query parameters when it's the only one
+class BookListParams(BaseModel):
+    limit: int = Field(default=Config.BOOKS_PAGE_SIZE, ge=1, le=Config.BOOKS_MAX_PAGE_SIZE)
+    cursor: Optional[str] = None
+    tag: List[str] = []
+    language: Optional[str] = None
+    author: Optional[str] = None
+    published_after: Optional[date] = None
+    published_before: Optional[date] = None
+    min_rating: Optional[float] = Field(default=None, ge=0, le=5)
+    sort: Literal["created_at", "published_date", "title", "rating"] = "created_at"
+
+    def has_filters(self) -> bool:
+        return bool(self.tag) or any(value is not None for value in (
+            self.language, self.author, self.published_after, self.published_before, self.min_rating
+        ))
+
+
+# one page of books. next_cursor is None when there are no more books to fetch
+class BookPageModel(BaseModel):
+    items: List[Book]
+    next_cursor: Optional[str] = None
+
+
+# a suggestion of the autocomplete, only what's needed to show it and to open the book
+class BookSuggestionModel(BaseModel):
+    uid: uuid.UUID
+    title: str
+    author: str
+
+
 class BookCreateModel(BaseModel):
     title: str
     author: str
@@ -32,6 +68,18 @@ class BookCreateModel(BaseModel):
 
 
 
+# the report of a bulk import. row is the number of the row in the file, starting from 1(the csv header is not counted)
+class BookImportError(BaseModel):
+    row: int
+    errors: List[str]
+
+
+class BookImportResult(BaseModel):
+    inserted: int
+    failed: int
+    errors: List[BookImportError] # only the first BOOK_IMPORT_MAX_ERRORS of them
+
+
 class BookUpdateModel(BaseModel):
     title: str
     author: str
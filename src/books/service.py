@@ -1,32 +1,193 @@
 from sqlmodel.ext.asyncio.session import AsyncSession
-from .schemas import BookCreateModel, BookUpdateModel
-from src.db.models import Book
-from sqlmodel import select, desc
-from datetime import datetime
+from .schemas import BookCreateModel, BookUpdateModel, BookImportError, BookListParams
+from .utils import encode_cursor, decode_cursor, like_prefix, suggest_cache_key
+from .cache import book_cache
+from src.db.models import Book, Review, BookTag, Tag
+from src.etag import make_etag
+from src.errors import PreconditionFailed
+from src.db.loaders import with_relationships
+from sqlmodel import select, desc, update, func
+from sqlalchemy import tuple_, cast, Float, insert, literal, or_
+from pydantic import ValidationError
+from src.config import Config
+from src.cache import TTLLRUCache
+from typing import AsyncIterator
+from datetime import datetime, date
+import uuid
+
+# the relationships that the book detail endpoint returns alongside the book
+BOOK_DETAIL_RELATIONSHIPS = (Book.reviews, Book.tags)
+
+# the orders the book lists can be sorted in, the column of the sort key and whether it's descending
+# the newest, most recently published and best rated books come first, titles are in alphabetical order
+BOOK_SORTS = {
+    "created_at": (Book.created_at, True),
+    "published_date": (Book.published_date, True),
+    "title": (Book.title, False),
+    "rating": (Book.average_rating, True),
+}
+
+# postgres accepts at most 32767 bind parameters in one statement and every column of every imported book takes one,
+# so a bigger BOOK_IMPORT_BATCH_SIZE is lowered to this
+BOOK_IMPORT_MAX_BATCH_SIZE = 32767 // len(Book.__table__.columns)
+
+# the results of the short prefixes that are typed into the book suggest box
+book_suggest_cache = TTLLRUCache(max_size=Config.SUGGEST_CACHE_MAX_SIZE, ttl=Config.SUGGEST_CACHE_TTL)
+
+# the ETag of a book. book can be a Book obj or the row returned by get_book_version
+def book_etag(book) -> str:
+    return make_etag("book", book.uid, book.version, book.updated_at)
+
 
 # Service class has all the logic for creating crud, so the moment we need to carry out the crud operations the only thing we should do is to use Service class's methods
 # we use this class so we can separate our crud codes from our route handlers and make the codes cleaner
 
 # session is a medium by sqlmodel and sqlalchemy so we can have access to our db and carry out transaction on it.
 class BookService:
-    async def get_all_books(self, session: AsyncSession):
-        statement = select(Book).order_by(desc(Book.created_at))
+    async def get_all_books(self, session: AsyncSession, limit: int, cursor: str | None = None, filters: BookListParams | None = None):
+        statement = select(Book)
+        return await self._get_page(statement, limit, cursor, filters or BookListParams(), session)
+
+    async def get_user_books(self, user_uid: str, session: AsyncSession, limit: int, cursor: str | None = None, filters: BookListParams | None = None):
+        statement = select(Book).where(Book.user_uid == user_uid)
+        return await self._get_page(statement, limit, cursor, filters or BookListParams(), session)
+
+
+    # this function returns one page of books and the cursor of the next page (keyset pagination)
+    # instead of OFFSET, which makes the db walk over every skipped row, we continue right after the last book the client has seen
+    # books are ordered by (sort key, uid). uid breaks the tie between books with the same key so no book is skipped or repeated
+    # every sort has an index in the same order(see the 5a0c8e3f9d21 migration), so a page is read straight from the index
+    async def _get_page(self, statement, limit: int, cursor: str | None, filters: BookListParams, session: AsyncSession):
+        statement = self._apply_filters(statement, filters)
+        column, descending = BOOK_SORTS[filters.sort]
+        if cursor is not None:
+            key, uid = decode_cursor(cursor, filters.sort)
+            # continuing a descending order means the smaller keys, an ascending one the bigger keys
+            if descending:
+                statement = statement.where(tuple_(column, Book.uid) < tuple_(key, uid))
+            else:
+                statement = statement.where(tuple_(column, Book.uid) > tuple_(key, uid))
+
+        # we fetch one extra row, if it exists we know there is a next page
+        order = (desc(column), desc(Book.uid)) if descending else (column, Book.uid)
+        statement = statement.order_by(*order).limit(limit + 1)
         result = await session.exec(statement)
-        return result.all()
+        books = result.all()
+
+        next_cursor = None
+        if len(books) > limit:
+            books = books[:limit]
+            last_book = books[-1]
+            next_cursor = encode_cursor(filters.sort, getattr(last_book, column.key), last_book.uid)
+
+        return {"items": books, "next_cursor": next_cursor}
+
+
+    # every filter is a plain comparison on a column of books, so the db can use the indexes on them
+    def _apply_filters(self, statement, filters: BookListParams):
+        if filters.tag:
+            statement = self._filter_tagged(statement, filters.tag)
+        if filters.language is not None:
+            statement = statement.where(Book.language == filters.language)
+        if filters.author is not None:
+            statement = statement.where(Book.author == filters.author)
+        if filters.published_after is not None:
+            statement = statement.where(Book.published_date >= filters.published_after)
+        if filters.published_before is not None:
+            statement = statement.where(Book.published_date <= filters.published_before)
+        if filters.min_rating is not None:
+            statement = statement.where(Book.average_rating >= filters.min_rating)
+        return statement
+
+
+    # keeps the books that have at least one of the tags. the subquery is answered by the indexes of tags.name and booktag.tag_id
+    def _filter_tagged(self, statement, tag_names: list[str]):
+        tagged_books = select(BookTag.book_id).join(Tag, Tag.uid == BookTag.tag_id).where(Tag.name.in_(tag_names))
+        return statement.where(Book.uid.in_(tagged_books))
+
+
+    # this function searches the title, author and publisher of the books and returns the best matches first
+    # q is parsed with websearch_to_tsquery, so clients can use the syntax of search engines: "quoted phrases", or, -excluded
+    # pages continue after the (rank, uid) of the last book, just like the (created_at, uid) of the book lists
+    async def search_books(self, q: str, session: AsyncSession, limit: int, cursor: str | None = None,
+                           tag: str | None = None, language: str | None = None):
+        # the column is on the table but not on the model(see src/db/models.py), and it was built with the 'english' config so the query must use it too
+        search_vector = Book.__table__.c.search_vector
+        query = func.websearch_to_tsquery("english", q)
+        rank = func.ts_rank(search_vector, query).label("rank")
+
+        statement = select(Book, rank).where(search_vector.op("@@")(query))
+        if language is not None:
+            statement = statement.where(Book.language == language)
+        if tag is not None:
+            statement = self._filter_tagged(statement, [tag])
+        if cursor is not None:
+            last_rank, last_uid = decode_cursor(cursor, "rank")
+            statement = statement.where(tuple_(rank, Book.uid) < tuple_(last_rank, last_uid))
+
+        statement = statement.order_by(desc(rank), desc(Book.uid)).limit(limit + 1)
+        result = await session.exec(statement)
+        rows = result.all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last_book, last_rank = rows[-1]
+            next_cursor = encode_cursor("rank", last_rank, last_book.uid)
+
+        return {"items": [book for book, _ in rows], "next_cursor": next_cursor}
+
+
+    # this function returns the books whose title or author starts with q or looks like q, for the autocomplete of the front end
+    # "looks like" is the trigram word similarity of pg_trgm(q <% title), so small typos still find the book
+    # both kinds of matches are answered by the trigram indexes of title and author(see the e2b9d4f7a163 migration)
+    async def suggest_books(self, q: str, session: AsyncSession, limit: int):
+        q = q.strip().lower()
+        if not q: # only spaces were typed, everything would match
+            return []
+        cache_key = suggest_cache_key(q, limit)
+        if cache_key is not None:
+            suggestions = book_suggest_cache.get(cache_key)
+            if suggestions is not None:
+                return suggestions
 
-    async def get_user_books(self, user_uid: str, session: AsyncSession):
-        statement = select(Book).where(Book.user_uid == user_uid).order_by(desc(Book.created_at))
+        prefix = like_prefix(q)
+        typed = literal(q)
+        # books that really start with q come first, then the ones that are most similar to it
+        is_prefix = or_(Book.title.ilike(prefix), Book.author.ilike(prefix))
+        similarity = func.greatest(func.word_similarity(typed, Book.title), func.word_similarity(typed, Book.author))
+        statement = (
+            select(Book.uid, Book.title, Book.author)
+            .where(or_(is_prefix, typed.op("<%")(Book.title), typed.op("<%")(Book.author)))
+            .order_by(desc(is_prefix), desc(similarity), Book.title)
+            .limit(limit)
+        )
         result = await session.exec(statement)
-        return result.all()
+        suggestions = [dict(row._mapping) for row in result.all()]
 
+        if cache_key is not None:
+            book_suggest_cache.set(cache_key, suggestions)
+        return suggestions
 
-    async def get_book(self, book_uid: str,  session: AsyncSession):
-        statement = select(Book).where(Book.uid == book_uid)
+
+    # load is the relationships of the book that the caller needs. the rest of them are not loaded
+    # for_update locks the row until the transaction ends, so nobody else can change the book in between
+    async def get_book(self, book_uid: str,  session: AsyncSession, load=(), for_update: bool = False):
+        statement = with_relationships(select(Book).where(Book.uid == book_uid), load)
+        if for_update:
+            statement = statement.with_for_update().execution_options(populate_existing=True)
         result = await session.exec(statement)
         book = result.first()
         return book if book is not None else None
 
 
+    # this function reads only the columns the ETag of a book is made of, it returns None if the book doesn't exist
+    async def get_book_version(self, book_uid: str, session: AsyncSession):
+        statement = select(Book.uid, Book.version, Book.updated_at).where(Book.uid == book_uid)
+        result = await session.exec(statement)
+        return result.first()
+
+
     async def create_book(self, book_data: BookCreateModel, user_uid: str, session: AsyncSession):
         book_data_dict = book_data.model_dump() # this line turns our json to dictionary
         new_book = Book(**book_data_dict) # this line unpacks our book_data_dictionary. it will create a new_book obj with attrs it gets from the book_data_dict
@@ -36,18 +197,102 @@ class BookService:
         new_book.user_uid = user_uid
         session.add(new_book)
         await session.commit()
+        await book_cache.invalidate_books()
         return new_book
 
 
-    async def update_book(self, book_uid: str, update_data: BookUpdateModel, session: AsyncSession):
-        book_to_update = await self.get_book(book_uid, session)
+    # this function yields the books for the export in batches(lists of rows), only with the given columns
+    # session.stream uses a server side cursor, so the db sends the rows as we read them instead of all of them at once
+    # and yield_per makes sqlalchemy keep only one batch in memory, so the memory use is the same whatever the number of books
+    async def stream_books(self, columns: list[str], session: AsyncSession, user_uid: str | None = None,
+                           created_after: datetime | None = None, created_before: datetime | None = None):
+        statement = select(*(getattr(Book, column) for column in columns))
+        if user_uid is not None:
+            statement = statement.where(Book.user_uid == user_uid)
+        if created_after is not None:
+            statement = statement.where(Book.created_at >= created_after)
+        if created_before is not None:
+            statement = statement.where(Book.created_at < created_before)
+        statement = statement.order_by(Book.created_at, Book.uid).execution_options(yield_per=Config.BOOK_EXPORT_BATCH_SIZE)
+
+        result = await session.stream(statement)
+        async for rows in result.partitions():
+            yield rows
+
+
+    # this function inserts the rows of a bulk import, rows comes from iter_ndjson_rows or iter_csv_rows
+    # rows are validated one by one as they arrive and inserted with one INSERT ... VALUES per batch, so the file is never all in memory
+    # every batch is committed on its own, so a bad row only fails itself and the rows around it are still imported
+    async def import_books(self, rows: AsyncIterator[dict | str], user_uid: str, session: AsyncSession) -> dict:
+        inserted = 0
+        failed = 0
+        errors = []
+        batch = []
+        batch_size = min(Config.BOOK_IMPORT_BATCH_SIZE, BOOK_IMPORT_MAX_BATCH_SIZE)
+
+        async def flush():
+            nonlocal inserted
+            if batch:
+                await session.exec(insert(Book).values(batch))
+                await session.commit()
+                inserted += len(batch)
+                batch.clear()
+
+        row_number = 0
+        async for row in rows:
+            row_number += 1
+            book, row_errors = self._parse_import_row(row)
+            if row_errors:
+                failed += 1
+                if len(errors) < Config.BOOK_IMPORT_MAX_ERRORS:
+                    errors.append(BookImportError(row=row_number, errors=row_errors))
+                continue
+
+            now = datetime.now()
+            book.update(uid=uuid.uuid4(), user_uid=user_uid, created_at=now, updated_at=now)
+            batch.append(book)
+            if len(batch) >= batch_size:
+                await flush()
+        await flush()
+
+        if inserted:
+            await book_cache.invalidate_books()
+        return {"inserted": inserted, "failed": failed, "errors": errors}
+
+
+    # this function returns the columns of the book to insert, or the errors that make the row invalid
+    def _parse_import_row(self, row: dict | str) -> tuple[dict | None, list[str]]:
+        if isinstance(row, str): # the line couldn't even be read
+            return None, [row]
+        try:
+            book_data = BookCreateModel.model_validate(row)
+        except ValidationError as e:
+            return None, [f"{'.'.join(str(loc) for loc in error['loc'])}: {error['msg']}" for error in e.errors()]
+        book = book_data.model_dump()
+        try:
+            # fromisoformat is a lot faster than strptime, and it parses the same YYYY-MM-DD dates
+            book["published_date"] = date.fromisoformat(book["published_date"])
+        except ValueError:
+            return None, ["published_date: must be a date in the YYYY-MM-DD format"]
+        return book, []
+
+
+    # expected_version is the version the client has seen(If-Match). if the book has been changed since then, PreconditionFailed is raised
+    async def update_book(self, book_uid: str, update_data: BookUpdateModel, session: AsyncSession, expected_version: int | None = None):
+        book_to_update = await self.get_book(book_uid, session, for_update=True)
 
         if book_to_update is not None:
+            if expected_version is not None and book_to_update.version != expected_version:
+                raise PreconditionFailed()
+
             update_data_dict = update_data.model_dump()
             for k, v in update_data_dict.items():
                 # the setattr func will get an obj such as book_to_update obj, and then it will update it base on the keys and its respective value
                 setattr(book_to_update, k,v)
+            book_to_update.version += 1 # the row is locked, so no other request can increment it at the same time
+            book_to_update.updated_at = datetime.now()
             await session.commit()
+            await book_cache.invalidate_books(book_to_update.uid)
             return book_to_update
         else:
             return None
@@ -58,7 +303,61 @@ class BookService:
         if book_to_delete is not None:
             await session.delete(book_to_delete)
             await session.commit()
+            await book_cache.invalidate_books(book_to_delete.uid)
             return {"done"}
         else:
             return None
 
+
+    # this function changes the review aggregates of a book when a review is added(review_count=1) or deleted(review_count=-1)
+    # the new values are computed by the db from the current ones, so two reviews saved at the same time can't overwrite each other
+    # it does not commit, the caller commits it together with the review itself
+    async def update_rating_aggregates(self, book_uid, review_count: int, rating: int, session: AsyncSession):
+        new_count = Book.review_count + review_count
+        new_sum = Book.rating_sum + rating
+        statement = update(Book).where(Book.uid == book_uid).values(
+            review_count=new_count,
+            rating_sum=new_sum,
+            average_rating=func.coalesce(cast(new_sum, Float) / func.nullif(new_count, 0), 0),
+            version=Book.version + 1, # the reviews are part of the book detail
+        )
+        await session.exec(statement)
+
+
+    # this function recomputes the review aggregates of every book from the reviews table and fixes the ones that are wrong
+    # it returns the uids of the books that have been fixed, and only their cached details are invalidated
+    async def recompute_rating_aggregates(self, session: AsyncSession) -> list:
+        stats = select(
+            Review.book_uid,
+            func.count(Review.uid).label("review_count"),
+            func.sum(Review.rating).label("rating_sum"),
+        ).where(Review.book_uid.is_not(None)).group_by(Review.book_uid).subquery()
+
+        # books that have reviews. we only write the rows whose values are actually wrong
+        statement = update(Book).where(Book.uid == stats.c.book_uid).where(
+            (Book.review_count != stats.c.review_count) | (Book.rating_sum != stats.c.rating_sum)
+        ).values(
+            review_count=stats.c.review_count,
+            rating_sum=stats.c.rating_sum,
+            average_rating=cast(stats.c.rating_sum, Float) / stats.c.review_count,
+            version=Book.version + 1,
+        ).returning(Book.uid).execution_options(synchronize_session=False)
+        fixed = list((await session.exec(statement)).scalars())
+
+        # books that have no reviews anymore but still have a count
+        has_reviews = select(Review.uid).where(Review.book_uid == Book.uid).exists()
+        statement = update(Book).where(Book.review_count != 0).where(~has_reviews).values(
+            review_count=0, rating_sum=0, average_rating=0, version=Book.version + 1,
+        ).returning(Book.uid).execution_options(synchronize_session=False)
+        fixed += (await session.exec(statement)).scalars()
+
+        await session.commit()
+        if fixed:
+            await book_cache.invalidate_books(*fixed)
+        return fixed
+
+
+    # this function increments the version of books whose detail has changed without the book row itself being changed, like when a tag is added to them
+    async def bump_versions(self, book_uids, session: AsyncSession):
+        statement = update(Book).where(Book.uid.in_(book_uids)).values(version=Book.version + 1)
+        await session.exec(statement)
@@ -0,0 +1,128 @@
+import base64
+import codecs
+import csv
+import io
+import json
+import uuid
+from datetime import datetime, date
+from typing import AsyncIterator
+from pydantic import BaseModel
+from src.errors import InvalidCursor
+from src.config import Config
+
+
+# the cursor is the position of the last book of a page, which is its (sort key, uid) pair
+# for example (created_at, uid) when the books are sorted by created_at, or (rank, uid) for the search results
+# the cursor also has the name of the sort, so a cursor of one order can't be used to continue another one
+# we hand it to the client as an opaque token so they don't depend on what is inside of it
+# base64 keeps the token url safe, so it can be sent back as a query parameter
+def encode_cursor(sort: str, value, uid: uuid.UUID) -> str:
+    if isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    payload = json.dumps({"s": sort, "k": value, "u": str(uid)})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+# these functions turn the sort key of a cursor back to its type
+CURSOR_KEY_PARSERS = {
+    "created_at": datetime.fromisoformat,
+    "published_date": date.fromisoformat,
+    "title": str,
+    "rating": float,
+    "rank": float,
+}
+
+
+# this function turns the token back to the (sort key, uid) pair
+# any token that has been tampered with, is not ours or belongs to another sort is rejected with InvalidCursor
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if payload["s"] != sort:
+            raise InvalidCursor()
+        return CURSOR_KEY_PARSERS[sort](payload["k"]), uuid.UUID(payload["u"])
+    except (ValueError, KeyError, TypeError):
+        raise InvalidCursor()
+
+
+# the suggest endpoints match what the user has typed so far against the start of the names(ILIKE 'q%')
+# % and _ are wildcards in LIKE patterns, so they are escaped to be matched as they are
+def like_prefix(q: str) -> str:
+    return q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+# the key of the suggest caches, only short prefixes are cached(None means the query should not be cached)
+def suggest_cache_key(q: str, limit: int) -> tuple[str, int] | None:
+    if len(q) > Config.SUGGEST_CACHE_PREFIX_LENGTH:
+        return None
+    return q, limit
+
+
+# these functions turn a request body that arrives in chunks into rows(dicts), without reading the whole body into memory
+# chunks can end in the middle of a line or even of a utf-8 character, so the incremental decoder keeps the unfinished bytes for the next chunk
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n") # the last part has no newline yet, so it waits for the next chunk
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer.strip():
+        yield buffer.rstrip("\r")
+
+
+# every row is either a dict or the error that made the line unreadable
+async def iter_ndjson_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[dict | str]:
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield f"invalid json: {e}"
+            continue
+        yield row if isinstance(row, dict) else "the row must be a json object"
+
+
+# the first line of the csv is the header with the field names
+# a quoted field can have newlines in it, so a record goes on until all of its quotes are closed(the number of quotes is even)
+async def iter_csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[dict | str]:
+    header = None
+    record = ""
+    async for line in iter_lines(chunks):
+        record = f"{record}\n{line}" if record else line
+        if record.count('"') % 2 == 1:
+            continue
+        if record.strip():
+            values = next(csv.reader([record]))
+            if header is None:
+                header = [name.strip() for name in values]
+            elif len(values) != len(header):
+                yield f"expected {len(header)} fields but got {len(values)}"
+            else:
+                yield dict(zip(header, values))
+        record = ""
+    if record:
+        yield "the last row has an unclosed quote"
+
+
+# these functions turn a batch of exported rows into the text that is sent to the client
+# rows are validated with model so the values are written the same way as in the other endpoints(for example uuids and dates)
+def ndjson_chunk(rows, model: type[BaseModel]) -> str:
+    return "".join(model.model_validate(row._mapping).model_dump_json() + "\n" for row in rows)
+
+
+def csv_chunk(rows, model: type[BaseModel]) -> str:
+    output = io.StringIO()
+    writer = csv.writer(output)
+    for row in rows:
+        writer.writerow(model.model_validate(row._mapping).model_dump(mode="json").values())
+    return output.getvalue()
+
+
+def csv_header(model: type[BaseModel]) -> str:
+    output = io.StringIO()
+    csv.writer(output).writerow(model.model_fields)
+    return output.getvalue()
@@ -1,7 +1,12 @@
 from celery import Celery
-from src.mail import mail, create_message
+from celery.signals import worker_process_init, worker_process_shutdown
+from celery.utils.time import get_exponential_backoff_interval
+from src.smtp import build_message, mail_batcher, smtp_pool, TransientMailError
+from src.email_templates import load_templates, render_email
+from src.config import Config
 # async_to_sync converts async code to sync code so we can run the async code inside the context of a sync code
 from asgiref.sync import async_to_sync
+import logging
 
 c_app = Celery()
 
@@ -10,16 +15,99 @@ c_app.config_from_object('src.config')
 
 
 # here we create our first task
-@c_app.task() # this means the following function is a celery task
-def send_email(recipients: list[str], subject: str, body: str):
-    message = create_message(recipients=recipients, subject=subject, body=body)  # this line returns a message schema
+# this task sends email to users, and it takes a lot of time so we must push it to a background task using Celery
+# the task only gets the name of the template and its variables, the html is rendered here in the worker(see send_to_recipients)
+@c_app.task(bind=True, max_retries=Config.MAIL_MAX_RETRIES) # this means the following function is a celery task
+def send_templated_email(self, recipients: list[str], subject: str, template: str, context: dict, already_sent: int = 0):
+    return send_to_recipients(self, recipients, subject, template, context, already_sent)
 
-    # this task sends email to users, and it takes a lot of time so we must push it to a background task using Celery
 
-    # celery tasks are not going to be asynchronous, so celery does not support sending async tasks inside our function
-    # we must make that task run within our synchronous code. this is doable by a tool named asgiref(it is used in django)
-    # it allows us to run our asynchronous code(mail.send_message()) inside the context of a synchronous code(send_email())
-    async_to_sync(mail.send_message)(message)
+# the app used to send the rendered html in the task itself. this task keeps that signature, so the send_email tasks that are still
+# in the queue during an upgrade are sent and not rejected by the new workers. nothing sends it anymore, it can be removed in the next release
+# the message is sent by the batcher of this process, and if the mail server is down or busy the task is tried again later,
+# each time waiting about twice as long(retry_backoff), with some randomness(retry_jitter)
+@c_app.task(
+    autoretry_for=(TransientMailError,),
+    retry_backoff=True,
+    retry_backoff_max=Config.MAIL_RETRY_BACKOFF_MAX,
+    retry_jitter=True,
+    max_retries=Config.MAIL_MAX_RETRIES,
+)
+def send_email(recipients: list[str], subject: str, body: str):
+    message = build_message(recipients=recipients, subject=subject, html=body)
+    mail_batcher.send(message)
     print("Email sent")
 
 
+# this task sends one chunk of a bulk email(see MailOutbox.send_bulk), the chunks of one email run at the same time on all the workers
+# rate_limit is how many chunks one worker may start per second/minute, so a huge list doesn't flood the mail server
+@c_app.task(bind=True, max_retries=Config.MAIL_MAX_RETRIES, rate_limit=Config.MAIL_BULK_RATE_LIMIT)
+def send_email_chunk(self, recipients: list[str], subject: str, template: str, context: dict, already_sent: int = 0):
+    return send_to_recipients(self, recipients, subject, template, context, already_sent)
+
+
+# the html is rendered once for every recipient, and every message goes to the batcher of this process as soon as it's rendered
+# so rendering the next ones and sending the first ones happen at the same time, on connections that stay open(see src/smtp.py)
+# the recipients the mail server could not take for now(TransientMailError) are tried again later by themselves,
+# each time waiting about twice as long, with some randomness. the ones that have been sent are not sent again
+# it returns the number of recipients the email has been sent to, already_sent counts the ones sent by the tries before this one
+def send_to_recipients(task, recipients: list[str], subject: str, template: str, context: dict, already_sent: int = 0) -> int:
+    futures = {}
+    for recipient in recipients:
+        html = render_email(template, context, recipient=recipient)
+        futures[recipient] = mail_batcher.submit(build_message(recipients=[recipient], subject=subject, html=html))
+
+    sent = 0
+    failed = []
+    for recipient, future in futures.items():
+        try:
+            future.result()
+            sent += 1
+        except TransientMailError:
+            failed.append(recipient)
+        except Exception as e:
+            logging.error("could not send the %s email to %s: %s", template, recipient, e)
+
+    logging.info("the %s email has been sent to %d recipients", template, sent)
+    if failed:
+        countdown = get_exponential_backoff_interval(
+            factor=1, retries=task.request.retries, maximum=Config.MAIL_RETRY_BACKOFF_MAX, full_jitter=True
+        )
+        raise task.retry(args=(failed, subject, template, context), kwargs={"already_sent": already_sent + sent}, countdown=countdown)
+    return already_sent + sent
+
+
+# every worker process compiles the email templates when it starts, so the first emails don't have to
+@worker_process_init.connect
+def compile_email_templates(**kwargs):
+    load_templates()
+
+
+# the connections of the pool are closed politely(QUIT) when a worker process stops
+@worker_process_shutdown.connect
+def close_smtp_connections(**kwargs):
+    smtp_pool.close()
+
+
+
+# this task repairs the review_count, rating_sum and average_rating of books in case they have drifted from the reviews table
+# it can be run by hand(recompute_book_ratings.delay()) or periodically with celery beat
+@c_app.task()
+def recompute_book_ratings():
+    from src.books.service import BookService
+    from src.db.main import async_engine, async_session_factory
+    from src.db.redis import close_redis
+
+    async def recompute():
+        try:
+            async with async_session_factory() as session:
+                return await BookService().recompute_rating_aggregates(session)
+        finally:
+            # async_to_sync runs every call in a new event loop, and connections can't be used outside the loop they were opened in
+            # so we close them here instead of leaving them in the pool for the next task(the same goes for redis, used by the book cache)
+            await async_engine.dispose()
+            await close_redis()
+
+    fixed = len(async_to_sync(recompute)())
+    print(f"Rating aggregates fixed for {fixed} books")
+    return fixed
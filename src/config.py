@@ -1,4 +1,5 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import Literal
 
 
 # this class is our Setting class in which we would set our environment variable in it as attrs(keys) and we would get their values by using model_config and give its path there.
@@ -8,6 +9,20 @@ class Settings(BaseSettings):
     JWT_ALGORITHM: str
 
     REDIS_URL: str = "redis://localhost:6379/0"
+    # the redis client(see src/db/redis.py). timeouts are in seconds
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_POOL_TIMEOUT: float = 1 # how long a call waits for a free connection when all of them are in use
+    REDIS_SOCKET_TIMEOUT: float = 0.5
+    REDIS_SOCKET_CONNECT_TIMEOUT: float = 1
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30
+    REDIS_RETRY_ATTEMPTS: int = 1
+    REDIS_RETRY_BACKOFF_BASE: float = 0.05
+    REDIS_RETRY_BACKOFF_CAP: float = 0.5
+    # after REDIS_BREAKER_FAILURE_THRESHOLD failed calls in a row, redis is not called for REDIS_BREAKER_RESET_TIMEOUT seconds
+    REDIS_BREAKER_FAILURE_THRESHOLD: int = 5
+    REDIS_BREAKER_RESET_TIMEOUT: float = 10
+    # what the token check does when redis can't be reached: "open" accepts the token, "closed" answers 503
+    BLOCKLIST_FAILURE_MODE: Literal["open", "closed"] = "closed"
 
     MAIL_USERNAME: str
     MAIL_PASSWORD: str
@@ -22,6 +37,92 @@ class Settings(BaseSettings):
 
     DOMAIN: str
 
+    # database connection pool. every uvicorn worker has its own pool so the db sees up to (DB_POOL_SIZE + DB_MAX_OVERFLOW) * workers connections
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30 # seconds a request waits for a free connection before it fails
+    DB_POOL_PRE_PING: bool = True # check a connection is still alive before handing it out
+    DB_POOL_RECYCLE: int = 1800 # seconds after which a connection is replaced, -1 disables it
+    # size of the prepared statement caches of asyncpg and of sqlalchemy. set them to 0 behind pgbouncer in transaction mode
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 100
+
+    # the authenticated user (uid, email, role, is_verified) is cached in every worker for USER_CACHE_TTL seconds
+    USER_CACHE_TTL: float = 60
+    USER_CACHE_MAX_SIZE: int = 10000
+
+    # bcrypt hashing runs in a thread pool of this size, so at most this many hashes are computed at the same time in a worker
+    PASSWORD_HASH_WORKERS: int = 4
+
+    # redis cache of the book detail and first page of the book lists. the TTLs are in seconds
+    BOOK_CACHE_ENABLED: bool = True
+    BOOK_CACHE_DETAIL_TTL: int = 300
+    BOOK_CACHE_LIST_TTL: int = 30
+    # when a cached entry is missing, only one request loads it from the db. the others wait up to this many seconds for it
+    BOOK_CACHE_LOCK_TIMEOUT: float = 2
+
+    # access log. a fraction ACCESS_LOG_SAMPLE_RATE of the requests is logged(server errors are always logged)
+    # lines wait in a queue of ACCESS_LOG_QUEUE_SIZE lines for a background thread to write them, and are dropped when it's full
+    ACCESS_LOG_SAMPLE_RATE: float = 1.0
+    ACCESS_LOG_QUEUE_SIZE: int = 10000
+
+    # sql instrumentation for development. when it's on, every response gets a Server-Timing header with the queries of the request
+    # and a warning is logged when a request runs more than SQL_QUERY_WARN_THRESHOLD queries or the same query SQL_REPEAT_WARN_THRESHOLD times(usually an N+1)
+    SQL_INSTRUMENTATION: bool = False
+    SQL_QUERY_WARN_THRESHOLD: int = 20
+    SQL_REPEAT_WARN_THRESHOLD: int = 5
+    SQL_SLOWEST_COUNT: int = 3 # how many of the slowest queries are sent in Server-Timing
+
+    # bulk import of books. rows are inserted and committed BOOK_IMPORT_BATCH_SIZE at a time(at most about 2100, see BOOK_IMPORT_MAX_BATCH_SIZE)
+    # only the first BOOK_IMPORT_MAX_ERRORS row errors are reported back, the rest are only counted
+    BOOK_IMPORT_BATCH_SIZE: int = 1000
+    BOOK_IMPORT_MAX_ERRORS: int = 100
+
+    # the book export reads the books from the db BOOK_EXPORT_BATCH_SIZE at a time and sends every batch as soon as it's read
+    BOOK_EXPORT_BATCH_SIZE: int = 1000
+
+    # the suggest(autocomplete) endpoints. results of the queries with at most SUGGEST_CACHE_PREFIX_LENGTH characters are cached in each worker
+    # those short prefixes are typed by everyone, and they are the slowest ones for the trigram indexes
+    SUGGEST_LIMIT: int = 10
+    SUGGEST_MAX_LIMIT: int = 25
+    SUGGEST_CACHE_PREFIX_LENGTH: int = 4
+    SUGGEST_CACHE_TTL: int = 60
+    SUGGEST_CACHE_MAX_SIZE: int = 5000
+
+    # the celery worker sends emails over SMTP_POOL_SIZE connections per process that stay open between messages(see src/smtp.py)
+    # a message waits up to SMTP_BATCH_LINGER seconds for others to be sent together with it, at most SMTP_BATCH_SIZE of them
+    # failed sends that can succeed later(the server is down or busy) are retried up to MAIL_MAX_RETRIES times, waiting longer every time
+    SMTP_POOL_SIZE: int = 2
+    SMTP_BATCH_SIZE: int = 50
+    SMTP_BATCH_LINGER: float = 0.05
+    SMTP_TIMEOUT: float = 30
+    SMTP_IDLE_CHECK: float = 30 # seconds after which an idle connection is checked with a NOOP before it's used again
+    MAIL_MAX_RETRIES: int = 5
+    MAIL_RETRY_BACKOFF_MAX: int = 600
+
+    # every email of the app goes through the outbox(see src/outbox.py). MAIL_OUTBOX_BACKEND is "celery" or "background"
+    # the background backend sends the emails from the server process itself, with MAIL_OUTBOX_WORKERS tasks and a queue of MAIL_OUTBOX_QUEUE_SIZE emails
+    # when the server stops it waits at most MAIL_OUTBOX_DRAIN_TIMEOUT seconds for the queue to be sent, the emails left after that are dropped
+    # emails with the same dedup key(like the password reset of one address) are sent once per MAIL_DEDUP_WINDOW seconds
+    MAIL_OUTBOX_BACKEND: Literal["celery", "background"] = "celery"
+    MAIL_OUTBOX_QUEUE_SIZE: int = 1000
+    MAIL_OUTBOX_WORKERS: int = 2
+    MAIL_OUTBOX_DRAIN_TIMEOUT: float = 10
+    MAIL_DEDUP_WINDOW: int = 300
+    # a bulk email(/send_mail) is split into tasks of MAIL_BULK_CHUNK_SIZE recipients that run on all the workers at once
+    # every worker starts at most MAIL_BULK_RATE_LIMIT of those tasks(celery rate limit format, like "10/s" or "100/m")
+    MAIL_BULK_CHUNK_SIZE: int = 500
+    MAIL_BULK_RATE_LIMIT: str = "60/m"
+
+    # every worker keeps the revoked tokens in memory, in sync with redis, so checking a token doesn't need a redis round trip
+    # revocations reach the other workers right away through pub/sub, and the whole blocklist is read again every BLOCKLIST_RESYNC_INTERVAL seconds
+    BLOCKLIST_LOCAL_CACHE: bool = True
+    BLOCKLIST_RESYNC_INTERVAL: int = 60
+
+    # pagination of the book list endpoints. clients can ask for any page size up to BOOKS_MAX_PAGE_SIZE
+    BOOKS_PAGE_SIZE: int = 20
+    BOOKS_MAX_PAGE_SIZE: int = 100
+
     # this class is used so we can influence our pydantic model and tell it where it can find the values of the attrs(keys) that we have set above, in our case it is .env file.
     # every pydantic model class has a model_config attr which is a dictionary. this dictionary will allow us to change the configuration of a specific pantic model
     model_config = SettingsConfigDict(
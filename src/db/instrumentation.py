@@ -0,0 +1,79 @@
+# this file counts and times the sql statements of every request, it is meant for development and is turned on with SQL_INSTRUMENTATION
+# sqlalchemy calls before_cursor_execute/after_cursor_execute around every statement it sends to the db
+# the stats of the current request live in a contextvar, so statements of different requests running at the same time don't get mixed
+# the middleware starts the stats of a request, and when the request is done it writes the Server-Timing header and the warnings
+import logging
+import time
+from collections import Counter
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from src.config import Config
+
+logger = logging.getLogger("bookly.sql")
+
+
+class QueryStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_time = 0.0 # seconds
+        self.statements: Counter[str] = Counter() # how many times each statement was run
+        self.timings: list[tuple[float, str]] = [] # (seconds, statement) of every query
+
+    def record(self, statement: str, duration: float) -> None:
+        self.count += 1
+        self.total_time += duration
+        # the parameters are sent apart from the statement, so the same query with different values has the same text
+        self.statements[statement] += 1
+        self.timings.append((duration, statement))
+
+    def slowest(self, n: int) -> list[tuple[float, str]]:
+        return sorted(self.timings, key=lambda timing: timing[0], reverse=True)[:n]
+
+    def repeated(self, threshold: int) -> list[tuple[str, int]]:
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+    # Server-Timing is shown by the browser dev tools in the network tab, next to the request
+    def server_timing(self) -> str:
+        metrics = [f'db;dur={self.total_time * 1000:.2f};desc="{self.count} queries"']
+        for i, (duration, statement) in enumerate(self.slowest(Config.SQL_SLOWEST_COUNT), start=1):
+            metrics.append(f'sql-{i};dur={duration * 1000:.2f};desc="{_short(statement)}"')
+        return ", ".join(metrics)
+
+
+query_stats: ContextVar[QueryStats | None] = ContextVar("query_stats", default=None)
+
+
+def _short(statement: str, length: int = 80) -> str:
+    statement = " ".join(statement.split()).replace('"', "'") # the description is a quoted string, so it can't have double quotes
+    return statement if len(statement) <= length else statement[:length - 3] + "..."
+
+
+def start_request_stats() -> QueryStats:
+    stats = QueryStats()
+    query_stats.set(stats)
+    return stats
+
+
+# this function logs the warnings for a request that is done
+def check_request_stats(stats: QueryStats, method: str, path: str) -> None:
+    if stats.count > Config.SQL_QUERY_WARN_THRESHOLD:
+        logger.warning("%s %s ran %d queries(%.2f ms)", method, path, stats.count, stats.total_time * 1000)
+    for statement, count in stats.repeated(Config.SQL_REPEAT_WARN_THRESHOLD):
+        logger.warning("%s %s ran the same query %d times, this could be an N+1: %s", method, path, count, _short(statement, 200))
+
+
+# async engines use a sync engine underneath, the events have to be registered on that one(async_engine.sync_engine)
+def instrument_engine(engine: Engine) -> None:
+    # the start time is kept on the execution context of the statement, when the statement fails
+    # after_cursor_execute is not called and the start time goes away with the context
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_start_time = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = context._query_start_time
+        stats = query_stats.get()
+        if stats is not None: # statements that don't belong to a request(like celery tasks) are not counted
+            stats.record(statement, time.perf_counter() - start)
@@ -0,0 +1,12 @@
+# every relationship in our models is lazy="raise", so a query only loads the relationships it asks for
+# services take a `load` argument which is the list of relationships the endpoint needs, for example (Book.reviews, Book.tags)
+# this function turns that list into selectinload options. selectinload loads each relationship with one extra "WHERE ... IN (...)" query
+# the nested relationships of the loaded objects stay unloaded, so loading book.tags does not pull in tag.books anymore
+from typing import Sequence
+from sqlalchemy.orm import selectinload, QueryableAttribute
+
+
+def with_relationships(statement, load: Sequence[QueryableAttribute] = ()):
+    if load:
+        statement = statement.options(*(selectinload(relationship) for relationship in load))
+    return statement
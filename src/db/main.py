@@ -1,17 +1,105 @@
 # here is the codes to connect to our db
 
-from sqlmodel import create_engine, text, SQLModel
-from sqlalchemy.ext.asyncio import AsyncEngine
+import time
+from sqlmodel import SQLModel
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from src.config import Config
 from sqlmodel.ext.asyncio.session import AsyncSession
-from sqlalchemy.orm import sessionmaker
 from src.db.models import Book
+from src.metrics import DB_POOL_CHECKOUTS, DB_POOL_TIMEOUTS, DB_POOL_WAIT, DB_POOL_IN_USE
+from src.db.instrumentation import instrument_engine
+
+
+# this class keeps the numbers about our connection pool, so we can see when requests are waiting for a connection
+class PoolStats:
+    def __init__(self) -> None:
+        self.checkouts = 0 # how many times a connection has been taken from the pool
+        self.timeouts = 0 # how many times a request gave up waiting for a connection
+        self.total_wait = 0.0 # seconds spent waiting for connections, over all checkouts
+        self.max_wait = 0.0
+
+    def record(self, wait: float) -> None:
+        self.checkouts += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        DB_POOL_CHECKOUTS.inc()
+        DB_POOL_WAIT.observe(wait)
+
+
+pool_stats = PoolStats()
+
+
+# this is the pool that sqlalchemy uses for async engines, we only time how long getting a connection out of it takes
+# when the pool is exhausted _do_get waits until another request returns its connection, so this is the time requests spend queued for the db
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_stats.timeouts += 1
+            DB_POOL_TIMEOUTS.inc()
+            raise
+        pool_stats.record(time.perf_counter() - start)
+        return connection
+
 
 # since we are using an async DB API, therefor, we need to create an async engine(AsyncEngine)
-async_engine = AsyncEngine(
-    create_engine(url= Config.DATABASE_URL) # echo=True will show the DB logs in our terminal so as we would have a better understanding of what's going on
+# the engine owns the connection pool, so we create it once per process and every request borrows connections from it
+async_engine = create_async_engine(
+    url=Config.DATABASE_URL, # echo=True will show the DB logs in our terminal so as we would have a better understanding of what's going on
+    poolclass=InstrumentedQueuePool,
+    pool_size=Config.DB_POOL_SIZE,
+    max_overflow=Config.DB_MAX_OVERFLOW,
+    pool_timeout=Config.DB_POOL_TIMEOUT,
+    pool_pre_ping=Config.DB_POOL_PRE_PING,
+    pool_recycle=Config.DB_POOL_RECYCLE,
+    connect_args={
+        "statement_cache_size": Config.DB_STATEMENT_CACHE_SIZE, # passed to asyncpg.connect()
+        "prepared_statement_cache_size": Config.DB_PREPARED_STATEMENT_CACHE_SIZE, # used by the sqlalchemy asyncpg dialect
+    },
 )
 
+# the pool emits these events when a connection is handed to a request and when it is given back
+@event.listens_for(async_engine.sync_engine.pool, "checkout")
+def on_pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_IN_USE.inc()
+
+
+@event.listens_for(async_engine.sync_engine.pool, "checkin")
+def on_pool_checkin(dbapi_connection, connection_record):
+    DB_POOL_IN_USE.dec()
+
+
+if Config.SQL_INSTRUMENTATION:
+    instrument_engine(async_engine.sync_engine)
+
+
+# Session is a class that is going to be created from async_sessionmaker and we bind it to our engine so that we can access our db
+# we are using sqlmodel AsyncSession so class_ tells the factory which class to use for creating a session
+# expire_on_commit= False allows us to use our session obj even after commiting transaction to our database
+# the factory is built once here, building it on every request would only waste time
+async_session_factory = async_sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+# this function returns the current state of the pool which can be used for metrics
+def get_pool_stats() -> dict:
+    pool = async_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(), # connections that are in use right now
+        "overflow": pool.overflow(),
+        "checkouts": pool_stats.checkouts,
+        "timeouts": pool_stats.timeouts,
+        "total_wait_seconds": pool_stats.total_wait,
+        "max_wait_seconds": pool_stats.max_wait,
+    }
+
+
 # this function will be used in the main(__init__.py) file, in the life_span function so as when the server starts we would hava a connection with the database(at the start of our app).
 # this function will allow us to build a connection to our database and keep that connection for as long as our application is running
 async def init_db():
@@ -23,12 +111,6 @@ async def init_db():
 # this function is responsible for returning our session we'll be using across all route handlers
 # the return type of this function is of AsyncSession
 async def get_session() -> AsyncSession:
-    # when we want to create a session we need a Session class and we'll be using sqlalchemy sessionmaker for that
-    # we are using sqlmodel AsyncSession and for that we need sessionmaker as it helps us to define any class that we want to use for creating a session
-    # Session is a class that is going to be created from our sessionmaker
-    # when we create a Session we need to bind it to an engine so that we can access our db
-    # expire_on_commit= False allows us to use our session obj even after commiting transaction to our database
-    Session = sessionmaker(bind= async_engine, class_= AsyncSession, expire_on_commit= False)
-    async with Session() as session:
+    async with async_session_factory() as session:
         yield session
-# and now we craeted our first dependency
\ No newline at end of file
+# and now we craeted our first dependency
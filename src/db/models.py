@@ -1,4 +1,5 @@
 from sqlmodel import SQLModel, Field, Column, Relationship
+from sqlalchemy import Index, Computed
 import sqlalchemy.dialects.postgresql as pg
 from datetime import datetime, date
 from typing import Optional, List
@@ -17,7 +18,7 @@ class User(SQLModel, table=True):
     # default is a new generated uid so that every field would be unique.
     uid: uuid.UUID = Field(sa_column=Column(pg.UUID, nullable=False, primary_key=True, default=uuid.uuid4))
     username: str
-    email: str
+    email: str = Field(unique=True, index=True) # every authenticated request looks the user up by email
     first_name: str
     last_name: str
     # a field that specify the role of a user
@@ -33,10 +34,13 @@ class User(SQLModel, table=True):
     # at books side we shall access to the user who is related to these books
     # we are going to get a list of books related to that user
     # now we must describe how sqlmodel or sqlalchemy is going to load this list of books
-    # SQLModel by default use lazy loading, but it can be problematic in asyncDB APIs, hence we would use another way of loading --> sa_relationship_kwargs={"lazy":"selectin"}
+    # SQLModel by default use lazy loading, but it can be problematic in asyncDB APIs
+    # loading every relationship with "selectin" is not a good idea either, because then every query on users would also fetch all their books and reviews
+    # so all our relationships are lazy="raise". they are never loaded unless the query asks for them with loader options (see src/db/loaders.py)
+    # and touching a relationship that was not asked for raises an error instead of silently running more queries
     # this allows us to access the books that a user will have submitted
-    books: List["Book"] = Relationship(back_populates="user", sa_relationship_kwargs={"lazy": "selectin"})
-    reviews: List["Review"] = Relationship(back_populates="user", sa_relationship_kwargs={"lazy": "selectin"})
+    books: List["Book"] = Relationship(back_populates="user", sa_relationship_kwargs={"lazy": "raise"})
+    reviews: List["Review"] = Relationship(back_populates="user", sa_relationship_kwargs={"lazy": "raise"})
 
 
     # we are defining this function on the class above so as it would give us a string presentation of the Book object we have stored in our db
@@ -47,7 +51,8 @@ class User(SQLModel, table=True):
 
 class BookTag(SQLModel, table=True):
     book_id: uuid.UUID = Field(default=None, foreign_key="books.uid", primary_key=True)
-    tag_id: uuid.UUID = Field(default=None, foreign_key="tags.uid", primary_key=True)
+    # the primary key (book_id, tag_id) already covers lookups by book, this index covers lookups by tag
+    tag_id: uuid.UUID = Field(default=None, foreign_key="tags.uid", primary_key=True, index=True)
 
 
 class Tag(SQLModel, table=True):
@@ -55,9 +60,10 @@ class Tag(SQLModel, table=True):
     uid: uuid.UUID = Field(
         sa_column=Column(pg.UUID, nullable=False, primary_key=True, default=uuid.uuid4)
     )
-    name: str = Field(sa_column=Column(pg.VARCHAR, nullable=False))
+    name: str = Field(sa_column=Column(pg.VARCHAR, nullable=False, unique=True, index=True))
+    version: int = Field(default=1, sa_column_kwargs={"server_default": "1"}) # incremented on every change, it is part of the ETag of the tag
     created_at: datetime = Field(sa_column=Column(pg.TIMESTAMP, default=datetime.now))
-    books: List["Book"] = Relationship(link_model=BookTag, back_populates="tags", sa_relationship_kwargs={"lazy": "selectin"})
+    books: List["Book"] = Relationship(link_model=BookTag, back_populates="tags", sa_relationship_kwargs={"lazy": "raise"})
 
     def __repr__(self) -> str:
         return f"<Tag {self.name}>"
@@ -87,6 +93,13 @@ class Book(SQLModel, table=True):
     # this user_id is going to be an optional field because it's going to be unnullable anyway and its type is uuid
     # in front of foreign_key we would write on of the fields of users table which we want it to relate to (tableName + filedName)
     user_uid: Optional[uuid.UUID] = Field(default=None, foreign_key="users.uid")
+    # these fields summarize the reviews of the book, so we don't have to load all the reviews to show its rating
+    # they are updated in the same transaction that adds or deletes a review (see ReviewService)
+    review_count: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    rating_sum: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    average_rating: float = Field(default=0, sa_column_kwargs={"server_default": "0"}) # it's 0 when the book has no reviews
+    # incremented whenever the book or anything shown in its detail(its reviews and tags) changes, it is part of the ETag of the book
+    version: int = Field(default=1, sa_column_kwargs={"server_default": "1"})
     # we are defining these two last fields as timestamp from postgresql dialect
     created_at: datetime = Field(sa_column=Column(pg.TIMESTAMP, default=datetime.now))
     updated_at: datetime = Field(sa_column=Column(pg.TIMESTAMP, default=datetime.now))
@@ -96,13 +109,13 @@ class Book(SQLModel, table=True):
     # ralationship function helps us use relationships to get those obj that are related to a certain obj such as the book obj
     # we are going to access that user table so we must use its model which is User
     # this field allows us to access the user who submitted this book
-    user: Optional["User"] = Relationship(back_populates="books")
+    user: Optional["User"] = Relationship(back_populates="books", sa_relationship_kwargs={"lazy": "raise"})
     # back_populates means in our user side we shall access all books that are related to that user and on our book side we shall access to the user who is related to this book
 
 
-    reviews: List["Review"] = Relationship(back_populates="book", sa_relationship_kwargs={"lazy": "selectin"})
+    reviews: List["Review"] = Relationship(back_populates="book", sa_relationship_kwargs={"lazy": "raise"})
 
-    tags: List[Tag] = Relationship(link_model=BookTag, back_populates="books", sa_relationship_kwargs={"lazy": "selectin"})
+    tags: List[Tag] = Relationship(link_model=BookTag, back_populates="books", sa_relationship_kwargs={"lazy": "raise"})
 
     # we are defining this function on the class above so as it would give us a string presentation of the Book object we have stored in our db
     # this is how we can visually see our User model
@@ -111,6 +124,33 @@ class Book(SQLModel, table=True):
         return f"<Book {self.username}>"
 
 
+# these indexes match the order of the book list endpoints (created_at DESC, uid DESC), so a page is read straight from the index
+# they are defined here because they need the columns of the books table, which only exist after the class is created
+Index("ix_books_created_at_uid", Book.__table__.c.created_at.desc(), Book.__table__.c.uid.desc())
+Index("ix_books_user_uid_created_at_uid", Book.__table__.c.user_uid, Book.__table__.c.created_at.desc(), Book.__table__.c.uid.desc())
+# and these match the other sorts and the language/author filters of the book lists
+Index("ix_books_published_date_uid", Book.__table__.c.published_date.desc(), Book.__table__.c.uid.desc())
+Index("ix_books_title_uid", Book.__table__.c.title, Book.__table__.c.uid)
+Index("ix_books_average_rating_uid", Book.__table__.c.average_rating.desc(), Book.__table__.c.uid.desc())
+Index("ix_books_language_created_at_uid", Book.__table__.c.language, Book.__table__.c.created_at.desc(), Book.__table__.c.uid.desc())
+Index("ix_books_author_created_at_uid", Book.__table__.c.author, Book.__table__.c.created_at.desc(), Book.__table__.c.uid.desc())
+# trigram indexes for the suggest endpoints, they answer ILIKE 'x%' and the similarity operator(see the e2b9d4f7a163 migration)
+Index("ix_books_title_trgm", Book.__table__.c.title, postgresql_using="gin", postgresql_ops={"title": "gin_trgm_ops"})
+Index("ix_books_author_trgm", Book.__table__.c.author, postgresql_using="gin", postgresql_ops={"author": "gin_trgm_ops"})
+Index("ix_tags_name_trgm", Tag.__table__.c.name, postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"})
+
+# search_vector is computed by postgres from the title, author and publisher, a match in the title(weight A) ranks higher than in the author(B) or the publisher(C)
+# it is added to the table and not to the model on purpose: the mapper never sees it, so loading books never reads it and inserts never write it
+# but it is still in the metadata, so autogenerate knows about it and its GIN index(see the c4a7e2d91b58 migration)
+BOOK_SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(author, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(publisher, '')), 'C')"
+)
+Book.__table__.append_column(Column("search_vector", pg.TSVECTOR, Computed(BOOK_SEARCH_VECTOR, persisted=True)))
+Index("ix_books_search_vector", Book.__table__.c.search_vector, postgresql_using="gin")
+
+
 ## Review Model
 
 class Review(SQLModel, table=True):
@@ -119,13 +159,13 @@ class Review(SQLModel, table=True):
     uid: uuid.UUID = Field(sa_column=Column(pg.UUID, nullable=False, primary_key=True, default=uuid.uuid4))
     rating: int = Field(lt=6, gt=0) # lt(lower than), gt(greater than)
     review_text: str # this means this field is simply a string and it will not be nullable
-    user_uid: Optional[uuid.UUID] = Field(default=None, foreign_key="users.uid")
-    book_uid: Optional[uuid.UUID] = Field(default=None, foreign_key="books.uid")
+    user_uid: Optional[uuid.UUID] = Field(default=None, foreign_key="users.uid", index=True)
+    book_uid: Optional[uuid.UUID] = Field(default=None, foreign_key="books.uid", index=True)
     created_at: datetime = Field(sa_column=Column(pg.TIMESTAMP, default=datetime.now))
     updated_at: datetime = Field(sa_column=Column(pg.TIMESTAMP, default=datetime.now))
     # user attribute allows us to access the user who created the review
-    user: Optional["User"] = Relationship(back_populates="reviews")
-    book: Optional["Book"] = Relationship(back_populates="reviews")
+    user: Optional["User"] = Relationship(back_populates="reviews", sa_relationship_kwargs={"lazy": "raise"})
+    book: Optional["Book"] = Relationship(back_populates="reviews", sa_relationship_kwargs={"lazy": "raise"})
 
     def __repr__(self): # this method returns a string representation of any object that we create out of this class
         return f"<Review for book {self.book_uid} by user {self.user_uid}>"
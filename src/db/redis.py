@@ -1,24 +1,265 @@
 # ioredis is our async io base client for redis
 import redis.asyncio as aioredis
 # it allows us to interact with redis from our python side by using different methods
+import asyncio
+import logging
+import time
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import RedisError, ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
 from src.config import Config
+from src.errors import ServiceUnavailable
+from src.metrics import REDIS_BLOCKLIST_DURATION, REDIS_CIRCUIT_OPEN
 
 # here we will set up our redis client object
 
-# this is our config for redis which is an obj created from redis, and it will connect us to redis
-token_blocklist = aioredis.from_url(Config.REDIS_URL)
+# the client is used by the token blocklist below, by the response cache of the book endpoints(src/books/cache.py) and by the mail outbox
+# it is created by init_redis() in the life_span of our app and closed by close_redis() when the server stops
+# everything gets it with get_redis(). outside the app(like in a celery task) get_redis() creates it the first time it's needed
+#
+# every call to redis has a time limit(REDIS_SOCKET_TIMEOUT) and is tried again REDIS_RETRY_ATTEMPTS times, waiting a bit longer every time
+# at most REDIS_MAX_CONNECTIONS connections are open, a request that finds all of them in use waits REDIS_POOL_TIMEOUT seconds at most for one
+# connections that have been idle for REDIS_HEALTH_CHECK_INTERVAL seconds are checked with a PING before they are used
+_redis: aioredis.Redis | None = None
 
+
+def create_redis() -> aioredis.Redis:
+    pool = aioredis.BlockingConnectionPool.from_url(
+        Config.REDIS_URL,
+        max_connections=Config.REDIS_MAX_CONNECTIONS,
+        timeout=Config.REDIS_POOL_TIMEOUT,
+        socket_timeout=Config.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=Config.REDIS_SOCKET_CONNECT_TIMEOUT,
+        health_check_interval=Config.REDIS_HEALTH_CHECK_INTERVAL,
+        retry=Retry(ExponentialBackoff(cap=Config.REDIS_RETRY_BACKOFF_CAP, base=Config.REDIS_RETRY_BACKOFF_BASE), Config.REDIS_RETRY_ATTEMPTS),
+        retry_on_timeout=True,
+    )
+    return aioredis.Redis(connection_pool=pool)
+
+
+def get_redis() -> aioredis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = create_redis()
+    return _redis
+
+
+async def init_redis() -> None:
+    try:
+        await get_redis().ping()
+    except RedisError as e:
+        # the app can still start, the circuit breaker and the fallbacks take care of the requests until redis is back
+        logging.warning("redis is not available: %s", e)
+
+
+async def close_redis() -> None:
+    global _redis
+    if _redis is not None:
+        await _redis.aclose(close_connection_pool=True)
+        _redis = None
+
+
+class CircuitOpenError(RedisError):
+    """Raised instead of calling redis while the circuit breaker is open"""
+
+
+# when redis is down or very slow every call would wait for its timeouts(and retries) before failing, which makes every request slow
+# so after REDIS_BREAKER_FAILURE_THRESHOLD failures in a row the breaker opens and calls fail right away with CircuitOpenError
+# after REDIS_BREAKER_RESET_TIMEOUT seconds one call is let through to test redis, if it works the breaker closes again
+# it is used as "async with redis_breaker:" around the calls to redis. CircuitOpenError is a RedisError, so the code that
+# already falls back when redis fails(like the book cache) does the same when the breaker is open
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._testing = False # a call is testing whether redis is back
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    async def __aenter__(self) -> "CircuitBreaker":
+        if self.opened_at is not None:
+            if self._testing or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("the redis circuit breaker is open")
+            self._testing = True
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        testing, self._testing = self._testing, False
+        # only the errors of the connection count, an error answered by redis itself means redis is working
+        if exc_type is not None and issubclass(exc_type, (RedisConnectionError, RedisTimeoutError, OSError, asyncio.TimeoutError)):
+            self.failures += 1
+            if testing or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logging.warning("redis is failing, the circuit breaker is open for %s seconds", self.reset_timeout)
+                self.opened_at = time.monotonic()
+                REDIS_CIRCUIT_OPEN.set(1)
+        elif exc_type is None or issubclass(exc_type, RedisError):
+            self.failures = 0
+            if self.opened_at is not None:
+                logging.info("redis is back, the circuit breaker is closed")
+            self.opened_at = None
+            REDIS_CIRCUIT_OPEN.set(0)
+        return False
+
+
+redis_breaker = CircuitBreaker(failure_threshold=Config.REDIS_BREAKER_FAILURE_THRESHOLD, reset_timeout=Config.REDIS_BREAKER_RESET_TIMEOUT)
+
+
+# the longest a token lives, used when we don't know the exp of a revoked token
 JTI_EXPIRY = 3600
 
+BLOCKLIST_KEY = "blocklist:jtis" # a sorted set of the revoked jtis, the score of a jti is the time its token expires
+BLOCKLIST_CHANNEL = "blocklist:revoked" # every revocation is published here, so every worker hears about it
+# before the sorted set every revoked jti had a key of its own, named by the bare jti(a uuid)
+# these keys are copied into the sorted set once(see migrate_legacy_blocklist), and BLOCKLIST_MIGRATED_KEY records that it has been done
+LEGACY_BLOCKLIST_PATTERN = "????????-????-????-????-????????????"
+BLOCKLIST_MIGRATED_KEY = "blocklist:migrated"
+
+
+# the legacy keys expire by themselves, so they are copied and not moved: workers of the previous release may still be checking them
+async def migrate_legacy_blocklist() -> None:
+    try:
+        if await get_redis().exists(BLOCKLIST_MIGRATED_KEY):
+            return
+        keys = []
+        async for key in get_redis().scan_iter(match=LEGACY_BLOCKLIST_PATTERN, count=1000):
+            keys.append(key)
+            if len(keys) >= 1000:
+                await _migrate_keys(keys)
+                keys = []
+        await _migrate_keys(keys)
+        await get_redis().set(BLOCKLIST_MIGRATED_KEY, "")
+    except RedisError as e:
+        # the next start tries again, until then the legacy keys are still checked when the local set is not in sync
+        logging.warning("could not migrate the legacy token blocklist: %s", e)
+
+
+# this function adds the jtis of the keys to the sorted set with the time their keys expire at, the TTLs are read with one round trip
+async def _migrate_keys(keys: list[bytes]) -> None:
+    if not keys:
+        return
+    async with get_redis().pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.pttl(key)
+        ttls = await pipe.execute()
+    now = time.time()
+    expiries = {
+        key.decode(): now + (ttl / 1000 if ttl >= 0 else JTI_EXPIRY)
+        for key, ttl in zip(keys, ttls) if ttl != -2 # -2 means the key has expired in the meantime
+    }
+    if expiries:
+        await get_redis().zadd(BLOCKLIST_KEY, expiries)
+
+
+# every worker keeps the jtis of the revoked tokens that have not expired yet, so checking a token doesn't need redis
+# the set is filled by reading the jtis of the sorted set that have not expired and then kept up to date by the messages of BLOCKLIST_CHANNEL
+# a message that is lost while the connection is down is caught by the next full read, which happens on every reconnect
+# and every BLOCKLIST_RESYNC_INTERVAL seconds. as long as the set is not in sync(ready is False) the blocklist is asked in redis as before
+class RevokedTokens:
+    def __init__(self) -> None:
+        self._expiries: dict[str, float] = {} # jti -> time.time() when the token expires
+        self.ready = False
+        self._task: asyncio.Task | None = None
+
+    def add(self, jti: str, expires_at: float) -> None:
+        self._expiries[jti] = max(expires_at, self._expiries.get(jti, 0))
+
+    def __contains__(self, jti: str) -> bool:
+        expires_at = self._expiries.get(jti)
+        return expires_at is not None and expires_at > time.time()
+
+    def _prune(self) -> None:
+        now = time.time()
+        self._expiries = {jti: expires_at for jti, expires_at in self._expiries.items() if expires_at > now}
+
+    async def resync(self) -> None:
+        entries = await get_redis().zrangebyscore(BLOCKLIST_KEY, time.time(), "+inf", withscores=True)
+        for jti, expires_at in entries:
+            self.add(jti.decode(), expires_at)
+        self._prune()
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = get_redis().pubsub()
+            try:
+                # we subscribe before reading the keys, so a token revoked in between is not missed
+                await pubsub.subscribe(BLOCKLIST_CHANNEL)
+                await self.resync()
+                self.ready = True
+                next_resync = time.monotonic() + Config.BLOCKLIST_RESYNC_INTERVAL
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is not None:
+                        jti, _, expires_at = message["data"].decode().partition(":")
+                        self.add(jti, float(expires_at))
+                    if time.monotonic() >= next_resync:
+                        await self.resync()
+                        next_resync = time.monotonic() + Config.BLOCKLIST_RESYNC_INTERVAL
+            except (RedisError, OSError, ValueError) as e:
+                self.ready = False
+                logging.warning("the local token blocklist is out of sync, checking tokens in redis: %s", e)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    # these two functions are called in the life_span of our app
+    def start(self) -> None:
+        if Config.BLOCKLIST_LOCAL_CACHE:
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.ready = False
+
+
+revoked_tokens = RevokedTokens()
+
 
 # we will store jti instead of tokens
 # this functions add the token to our blocklist
-async def add_jti_to_blocklist(jti: str) -> None:
-    # set method stores value in the db
-    # we send a key, a value and the expiry(the time we want that value to expire). note that this is how redis simply works
-    await token_blocklist.set(name=jti, value="", ex=JTI_EXPIRY)
+# exp is the expiry of the token(from its payload). the jti only has to be kept until then, after that the token is rejected anyway
+async def add_jti_to_blocklist(jti: str, exp: float | None = None) -> None:
+    expires_at = exp if exp is not None else time.time() + JTI_EXPIRY
+    try:
+        async with redis_breaker:
+            with REDIS_BLOCKLIST_DURATION.labels("add").time(): # time() measures how long the block takes
+                async with get_redis().pipeline(transaction=False) as pipe:
+                    pipe.zadd(BLOCKLIST_KEY, {jti: expires_at})
+                    # the jtis of the tokens that have expired are not needed anymore, so every revocation trims them
+                    pipe.zremrangebyscore(BLOCKLIST_KEY, "-inf", time.time())
+                    pipe.publish(BLOCKLIST_CHANNEL, f"{jti}:{expires_at}")
+                    await pipe.execute()
+    except RedisError:
+        # telling the user they have logged out when their token still works would be worse than an error
+        raise ServiceUnavailable()
+    revoked_tokens.add(jti, expires_at)
 
 # this function checks if that token exists in our blocklist
 async def token_in_blocklist(jti: str) -> bool:
-    jti = await token_blocklist.get(jti) # get method gets the key and returns it to us
-    return jti is not None # this line returns True or False depending on whether jti is None or not
+    if revoked_tokens.ready: # the local set is in sync, no need to ask redis
+        return jti in revoked_tokens
+    try:
+        async with redis_breaker:
+            with REDIS_BLOCKLIST_DURATION.labels("check").time():
+                # the legacy key of the jti is checked too, in case it has not been migrated yet
+                async with get_redis().pipeline(transaction=False) as pipe:
+                    pipe.zscore(BLOCKLIST_KEY, jti)
+                    pipe.exists(jti)
+                    expires_at, legacy_found = await pipe.execute()
+    except RedisError as e:
+        # when we can't reach redis, BLOCKLIST_FAILURE_MODE decides between accepting the token(it's still signed and not expired)
+        # and rejecting the request with 503. the first keeps the app working, the second never lets a revoked token in
+        if Config.BLOCKLIST_FAILURE_MODE == "open":
+            if not isinstance(e, CircuitOpenError): # the breaker has already logged that redis is down
+                logging.warning("the token blocklist is not available, accepting the token: %s", e)
+            return False
+        raise ServiceUnavailable()
+    # this line returns True or False depending on whether the jti is in the blocklist or not
+    return (expires_at is not None and expires_at > time.time()) or legacy_found > 0
@@ -0,0 +1,28 @@
+# this file renders the html of our emails from the jinja2 templates in src/templates/email
+# jinja2 turns every template into python code the first time it's loaded, and the static html of the template becomes constant strings in that code
+# so after a template has been compiled, rendering it only joins those strings with the variables of one recipient
+# load_templates() compiles all of them up front, it's called when a celery worker process starts(and by the server for the background outbox)
+# so the first emails don't pay for the compiling
+from pathlib import Path
+from jinja2 import Environment, FileSystemLoader, StrictUndefined, select_autoescape
+
+TEMPLATE_FOLDER = Path(__file__).resolve().parent / "templates"
+
+email_env = Environment(
+    loader=FileSystemLoader(TEMPLATE_FOLDER),
+    autoescape=select_autoescape(["html"]), # the variables are escaped, so a name with <script> in it is shown as text
+    undefined=StrictUndefined, # a variable that has not been passed is an error instead of an empty string
+    auto_reload=False, # templates don't change while the app runs, so jinja2 doesn't have to check the files on every render
+    cache_size=-1, # keep every compiled template
+)
+
+
+def load_templates() -> None:
+    for name in email_env.list_templates(filter_func=lambda name: name.startswith("email/") and name.endswith(".html")):
+        email_env.get_template(name)
+
+
+# template is the name of the file in src/templates/email without .html, like "verify_email"
+# recipient is the address the email is rendered for, the templates can use it to greet every recipient differently
+def render_email(template: str, context: dict, recipient: str | None = None) -> str:
+    return email_env.get_template(f"email/{template}.html").render(context, recipient=recipient)
@@ -65,6 +65,26 @@ class AccountNotVerified(BooklyException):
     """Account not yet verified"""
     pass
 
+class InvalidCursor(BooklyException):
+    """User has provided a pagination cursor that is malformed or has been tampered with"""
+    pass
+
+class PreconditionFailed(BooklyException):
+    """User has tried to change a resource that has been changed since they fetched it (If-Match did not match)"""
+    pass
+
+class UnsupportedMediaType(BooklyException):
+    """User has sent a body in a format that the endpoint does not accept"""
+    pass
+
+class MailJobNotFound(BooklyException):
+    """User has asked for the progress of a bulk email that does not exist or has expired"""
+    pass
+
+class ServiceUnavailable(BooklyException):
+    """A service the request depends on (like redis) is not available right now"""
+    pass
+
 # if we want to register our custom exceptions as ones that can be used by fastapi we need to create an exception handler
 # exception handler is a function that fastapi will use to customize the responses that are going to be returned
 
@@ -205,6 +225,65 @@ def register_all_errors(app: FastAPI):
         )
     )
 
+    app.add_exception_handler(
+        InvalidCursor,
+        create_exception_handler(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            initial_details={
+                "message": "the pagination cursor is invalid",
+                "error_code": "invalid_cursor",
+                "resolution": "Please use the next_cursor value returned by the previous page"
+            }
+        )
+    )
+
+    app.add_exception_handler(
+        PreconditionFailed,
+        create_exception_handler(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            initial_details={
+                "message": "the resource has been changed by someone else",
+                "error_code": "precondition_failed",
+                "resolution": "Please fetch the resource again and retry with its new ETag"
+            }
+        )
+    )
+
+    app.add_exception_handler(
+        UnsupportedMediaType,
+        create_exception_handler(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            initial_details={
+                "message": "the format of the request body is not supported",
+                "error_code": "unsupported_media_type",
+                "resolution": "Please send the body as application/x-ndjson or text/csv"
+            }
+        )
+    )
+
+    app.add_exception_handler(
+        MailJobNotFound,
+        create_exception_handler(
+            status_code=status.HTTP_404_NOT_FOUND,
+            initial_details={
+                "message": "mail job not found",
+                "error_code": "mail_job_not_found",
+            }
+        )
+    )
+
+    app.add_exception_handler(
+        ServiceUnavailable,
+        create_exception_handler(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            initial_details={
+                "message": "the service is temporarily unavailable",
+                "error_code": "service_unavailable",
+                "resolution": "Please try again in a few seconds"
+            }
+        )
+    )
+
     # here we went to customize Internal Server error
     # we customize these error by using exception_handler on app decorator
     # it takes in status code(we can also provide error classes like what we already did)
@@ -0,0 +1,40 @@
+# this file has the helpers for ETags and conditional requests
+# an ETag is a fingerprint of a version of a resource. we send it in the ETag header and the client sends it back:
+# - with If-None-Match on a GET: if the resource has not changed we answer 304 Not Modified with no body, so nothing has to be loaded or serialized
+# - with If-Match on a PATCH/PUT: if the resource has changed since the client fetched it we answer 412, so the client doesn't overwrite someone else's change
+# our ETags are built from the row version and updated_at, which can be read with a tiny query without loading the whole resource
+import hashlib
+from fastapi import Request, status
+from fastapi.responses import Response
+from src.errors import PreconditionFailed
+
+
+def make_etag(*parts) -> str:
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest}"' # ETags are sent between double quotes
+
+
+def _header_etags(header: str) -> list[str]:
+    return [etag.strip() for etag in header.split(",")]
+
+
+# this function returns a 304 response if the client already has this version of the resource, otherwise None
+def not_modified(request: Request, etag: str) -> Response | None:
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return None
+    # If-None-Match uses the weak comparison, so W/"abc" matches "abc"
+    etags = [e[2:] if e.startswith("W/") else e for e in _header_etags(header)]
+    if "*" in etags or etag in etags:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return None
+
+
+# this function raises PreconditionFailed if the client sent If-Match and it does not match the current version
+def check_if_match(request: Request, etag: str) -> None:
+    header = request.headers.get("if-match")
+    if header is None: # the client did not ask for a conditional update
+        return
+    etags = _header_etags(header)
+    if "*" not in etags and etag not in etags:
+        raise PreconditionFailed()
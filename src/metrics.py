@@ -0,0 +1,79 @@
+# this file has our prometheus metrics and the /metrics endpoint that prometheus scrapes
+#
+# with several uvicorn workers every worker is a separate process with its own metrics, and a scrape only reaches one of them
+# to get the numbers of all the workers, set the PROMETHEUS_MULTIPROC_DIR env variable to an empty directory before starting the server
+# then every process writes its metrics to files in that directory, and /metrics adds the files of all the processes together
+# the directory must be emptied between restarts of the server
+#
+# the files of a process stay in the directory after it exits, so every process must be marked dead when it stops(mark_process_dead)
+# otherwise the "live" gauges below keep adding the last value of the workers that are gone. the life_span of our app does it on a clean
+# shutdown, and a process manager that restarts crashed workers should do it for them too, like a gunicorn child_exit hook:
+#     def child_exit(server, worker):
+#         from src.metrics import mark_process_dead
+#         mark_process_dead(worker.pid)
+import os
+from fastapi import APIRouter
+from fastapi.responses import Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# these buckets are for things that usually take milliseconds
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "Number of HTTP requests", ["method", "route", "status"]
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time spent processing HTTP requests", ["method", "route", "status"]
+)
+
+DB_POOL_CHECKOUTS = Counter("db_pool_checkouts_total", "Number of connections taken from the db pool")
+DB_POOL_TIMEOUTS = Counter("db_pool_timeouts_total", "Number of requests that gave up waiting for a db connection")
+DB_POOL_WAIT = Histogram("db_pool_checkout_wait_seconds", "Time spent waiting for a db connection", buckets=FAST_BUCKETS)
+# livesum adds up the values of the processes that have not been marked dead(see mark_process_dead above)
+DB_POOL_IN_USE = Gauge("db_pool_connections_in_use", "Db connections in use right now", multiprocess_mode="livesum")
+
+REDIS_BLOCKLIST_DURATION = Histogram(
+    "redis_blocklist_duration_seconds", "Time spent on token blocklist calls to redis", ["operation"], buckets=FAST_BUCKETS
+)
+# 1 while the redis circuit breaker is open(see src/db/redis.py), livemax shows if it's open in any of the processes that are alive
+REDIS_CIRCUIT_OPEN = Gauge("redis_circuit_open", "Whether calls to redis are being skipped", multiprocess_mode="livemax")
+
+CELERY_ENQUEUE_DURATION = Histogram(
+    "celery_enqueue_duration_seconds", "Time spent sending a task to the celery broker", ["task"], buckets=FAST_BUCKETS
+)
+
+PASSWORD_HASH_DURATION = Histogram(
+    "password_hash_duration_seconds", "Time spent computing bcrypt hashes", ["operation"]
+)
+PASSWORD_HASH_QUEUED = Gauge(
+    "password_hash_queued", "Requests waiting for a free password hashing slot", multiprocess_mode="livesum"
+)
+
+
+def mark_process_dead(pid: int | None = None) -> None:
+    """Remove the live gauge files of a process that has stopped, pid is the current process by default"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid if pid is not None else os.getpid())
+
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get("/metrics", include_in_schema=False)
+async def metrics():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # a new registry that reads the metrics of all the processes from the files
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
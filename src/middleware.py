@@ -3,12 +3,67 @@ from fastapi.requests import Request
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
+from logging.handlers import QueueHandler, QueueListener
+from src.config import Config
+from src.metrics import HTTP_REQUESTS, HTTP_REQUEST_DURATION
+from src.db.instrumentation import start_request_stats, check_request_stats
 import time
+import json
+import queue
+import random
+import sys
 import logging
 
 # uvicorn.access is the one that logs some unnecessary things when we start our server
 logger = logging.getLogger("uvicorn.access")
-logger.disabled = True # this line will prevent those log to get written on our terminal
+logger.disabled = True # this line will prevent those log to get written on our terminal(our own access log below replaces it)
+
+
+# writing to stdout is slow, and doing it inside the request means the request waits for it
+# so the middleware only puts a log record in a queue, and a background thread(QueueListener) turns it into json and writes it
+class AccessLogQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0 # lines we have lost because the queue was full
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the default prepare formats the message in the request, we leave that to the background thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # if the writer can't keep up we'd rather lose log lines than make requests wait
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, default=str)
+
+
+access_log_queue = queue.Queue(maxsize=Config.ACCESS_LOG_QUEUE_SIZE)
+access_log_handler = AccessLogQueueHandler(access_log_queue)
+
+access_logger = logging.getLogger("bookly.access")
+access_logger.setLevel(logging.INFO)
+access_logger.propagate = False
+access_logger.addHandler(access_log_handler)
+
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(JsonFormatter())
+access_log_listener = QueueListener(access_log_queue, stdout_handler)
+
+
+# these two functions are called in the life_span of our app to start and stop the background writer
+# stop() writes the lines that are still in the queue before it returns
+def start_access_log() -> None:
+    access_log_listener.start()
+
+
+def stop_access_log() -> None:
+    access_log_listener.stop()
 
 
 
@@ -24,7 +79,9 @@ def register_middleware(app: FastAPI):
     # the second one is call_next which is another middleware that's going to be registered on our app as well as any route handler that we've defined
 
     async def custom_logging(request: Request, call_next):
-        start_time = time.time() # this variable store the current time at the moment
+        # perf_counter_ns is a monotonic clock, unlike time.time() it can't jump when the system clock is changed
+        start_time = time.perf_counter_ns() # this variable store the current time at the moment
+        stats = start_request_stats() if Config.SQL_INSTRUMENTATION else None
 
         # now we can calculate the processing time for this request
         # we must do what we want before the request is done(passed to the route handler)
@@ -35,10 +92,37 @@ def register_middleware(app: FastAPI):
         response = await call_next(request) # after this line request ends and it will pass to the route handler
 
 
-        processing_time = time.time() - start_time
+        duration_ms = (time.perf_counter_ns() - start_time) / 1_000_000
+
+        if stats is not None:
+            # queries that a streaming response runs while sending its body are not counted, they happen after this line
+            response.headers["Server-Timing"] = stats.server_timing()
+            check_request_stats(stats, request.method, request.url.path)
+
+        # the route template(like /api/v1/books/{book_uid}) groups the requests of an endpoint together, unlike the real path
+        # requests that match no route are grouped under one label, otherwise every random url would make a new metric
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        HTTP_REQUESTS.labels(request.method, route_path, response.status_code).inc()
+        HTTP_REQUEST_DURATION.labels(request.method, route_path, response.status_code).observe(duration_ms / 1000)
+
+        # we only log a sample of the requests, but server errors are always logged
+        if response.status_code < 500 and random.random() >= Config.ACCESS_LOG_SAMPLE_RATE:
+            return response
+
         # we want to get the request time and some other things. they all can be accessed via request obj
-        message = f"{request.client.host}:{request.client.port} - {request.method} - {request.url.path} - {response.status_code} completed after {processing_time} seconds"
-        print(message)
+        auth = getattr(request.state, "auth", None) # set by get_auth_context for authenticated requests
+        content_length = response.headers.get("content-length") # streaming responses don't have it
+        access_logger.info({
+            "method": request.method,
+            "route": route.path if route is not None else None,
+            "path": request.url.path,
+            "status": response.status_code,
+            "duration_ms": round(duration_ms, 3),
+            "bytes": int(content_length) if content_length is not None else None,
+            "user_uid": auth.user.uid if auth is not None else None,
+            "client": request.client.host if request.client else None,
+        })
 
         # when we are done processing the request with our middleware, we would return the response
         return response
@@ -0,0 +1,195 @@
+# this file is the outbox that every email of the app goes through. route handlers only hand their email to it and return right away,
+# the email is sent later by a backend, so the response never waits for the mail server:
+# - "celery": the email becomes a send_templated_email task, and the celery worker sends it(see src/celery_tasks.py)
+# - "background": the email waits in a queue of this process, and a few asyncio tasks of the same process send it with fastapi_mail
+#   this one needs no worker, but the emails still in the queue are lost if the process stops
+#
+# the emails are sent as the name of a template in src/templates/email and its variables(see src/email_templates.py)
+# the html is only rendered by whoever sends the email, once for every recipient, so the celery broker only carries the variables
+#
+# an email can have a dedup key, then the same key is only sent once within MAIL_DEDUP_WINDOW seconds
+# so someone asking for a password reset ten times in a row gets one email, not ten
+import asyncio
+import logging
+from celery import group, states
+from celery.backends.base import BaseKeyValueStoreBackend
+from celery.result import GroupResult
+from redis.exceptions import RedisError
+from src.config import Config
+from src.db.redis import get_redis, redis_breaker
+from src.mail import mail, create_message
+from src.email_templates import load_templates, render_email
+from src.metrics import CELERY_ENQUEUE_DURATION
+
+
+# the state and the result of many tasks. a task the backend knows nothing about is PENDING, like celery itself reports it
+def read_task_metas(backend, task_ids: list[str]) -> list[dict]:
+    if not isinstance(backend, BaseKeyValueStoreBackend):
+        return [backend.get_task_meta(task_id) for task_id in task_ids]
+    values = backend.mget([backend.get_key_for_task(task_id) for task_id in task_ids])
+    return [backend.decode_result(value) if value else {"status": states.PENDING, "result": None} for value in values]
+
+
+class CeleryMailBackend:
+    async def enqueue(self, recipients: list[str], subject: str, template: str, context: dict) -> None:
+        from src.celery_tasks import send_templated_email
+
+        def delay():
+            with CELERY_ENQUEUE_DURATION.labels("send_templated_email").time():
+                send_templated_email.delay(recipients, subject, template, context) # delay method means this function is a celery task
+
+        # delay talks to the broker with a blocking client, so it runs in a thread instead of blocking the event loop
+        await asyncio.to_thread(delay)
+
+    # the chunks are sent as one celery group, every chunk is a task that any worker can pick up
+    # the group result is stored in the result backend, so its id is the job id that the progress can be read with later
+    async def enqueue_bulk(self, chunks: list[list[str]], subject: str, template: str, context: dict) -> str:
+        from src.celery_tasks import send_email_chunk
+
+        def dispatch():
+            with CELERY_ENQUEUE_DURATION.labels("send_email_chunk").time():
+                result = group(send_email_chunk.s(chunk, subject, template, context) for chunk in chunks).apply_async()
+                result.save()
+            return result.id
+
+        return await asyncio.to_thread(dispatch)
+
+    async def bulk_status(self, job_id: str) -> dict | None:
+        from src.celery_tasks import c_app
+
+        def read():
+            result = GroupResult.restore(job_id, app=c_app)
+            if result is None:
+                return None
+            # asking every chunk for its state, its result and whether it's ready would read it from the backend each time
+            # so the state of all the chunks is read once(one MGET with the redis backend) and everything is counted from it
+            metas = read_task_metas(c_app.backend, [chunk.id for chunk in result.results])
+            succeeded = [meta for meta in metas if meta["status"] == states.SUCCESS]
+            return {
+                "job_id": job_id,
+                "chunks": len(metas),
+                "completed_chunks": len(succeeded),
+                "failed_chunks": sum(1 for meta in metas if meta["status"] == states.FAILURE),
+                "sent": sum(meta["result"] for meta in succeeded), # every chunk returns how many it has sent
+                "done": all(meta["status"] in states.READY_STATES for meta in metas),
+            }
+
+        return await asyncio.to_thread(read)
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class BackgroundMailBackend:
+    def __init__(self, queue_size: int, workers: int, drain_timeout: float) -> None:
+        self.queue_size = queue_size
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def enqueue(self, recipients: list[str], subject: str, template: str, context: dict) -> None:
+        if self._queue is None:
+            raise RuntimeError("the mail outbox has not been started")
+        try:
+            self._queue.put_nowait((recipients, subject, template, context))
+        except asyncio.QueueFull:
+            # we'd rather lose an email than make the request wait for the mail server
+            logging.error("the mail outbox is full, an email to %s has been dropped", recipients)
+
+    # the chunks just wait in the queue like other emails, their progress is not tracked(there is no job id)
+    async def enqueue_bulk(self, chunks: list[list[str]], subject: str, template: str, context: dict) -> None:
+        for chunk in chunks:
+            await self.enqueue(chunk, subject, template, context)
+        return None
+
+    async def bulk_status(self, job_id: str) -> None:
+        return None
+
+    async def _run(self) -> None:
+        while True:
+            recipients, subject, template, context = await self._queue.get()
+            try:
+                for recipient in recipients:
+                    try:
+                        html = render_email(template, context, recipient=recipient)
+                        await mail.send_message(create_message(recipients=[recipient], subject=subject, body=html))
+                    except Exception:
+                        logging.exception("could not send the %s email to %s", template, recipient)
+            finally:
+                self._queue.task_done()
+
+    async def start(self) -> None:
+        load_templates()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    # the emails that are already in the queue are sent before the server stops, as long as that takes less than drain_timeout
+    # seconds. a mail server that hangs would otherwise keep the server from stopping until it is killed
+    async def stop(self) -> None:
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=self.drain_timeout)
+            except asyncio.TimeoutError:
+                logging.error("the mail outbox was not sent within %s seconds, %d queued emails have been dropped",
+                              self.drain_timeout, self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+class MailOutbox:
+    def __init__(self, backend) -> None:
+        self.backend = backend
+
+    # this function returns False if the email has not been sent because one with the same dedup_key was sent recently
+    # template is the name of a file in src/templates/email without .html, context has the variables it needs
+    async def send(self, recipients: list[str], subject: str, template: str, context: dict | None = None,
+                   dedup_key: str | None = None) -> bool:
+        if dedup_key is not None and not await self._first_in_window(dedup_key):
+            return False
+        await self.backend.enqueue(recipients, subject, template, context or {})
+        return True
+
+    # this function sends the same email to a lot of recipients, split into chunks of MAIL_BULK_CHUNK_SIZE that are sent in parallel
+    # it returns the id of the job that bulk_status reports the progress of, or None if the backend can't track it
+    async def send_bulk(self, recipients: list[str], subject: str, template: str, context: dict | None = None) -> str | None:
+        size = Config.MAIL_BULK_CHUNK_SIZE
+        chunks = [recipients[i:i + size] for i in range(0, len(recipients), size)]
+        if not chunks:
+            return None
+        return await self.backend.enqueue_bulk(chunks, subject, template, context or {})
+
+    async def bulk_status(self, job_id: str) -> dict | None:
+        return await self.backend.bulk_status(job_id)
+
+    async def _first_in_window(self, dedup_key: str) -> bool:
+        try:
+            # NX only sets the key if it doesn't exist, so only the first email of the window gets True
+            async with redis_breaker:
+                return bool(await get_redis().set(f"outbox:dedup:{dedup_key}", "1", nx=True, ex=Config.MAIL_DEDUP_WINDOW))
+        except RedisError as e:
+            # without redis we can't know, sending the email twice is better than not sending it at all
+            logging.warning("mail dedup is not available: %s", e)
+            return True
+
+    async def start(self) -> None:
+        await self.backend.start()
+
+    async def stop(self) -> None:
+        await self.backend.stop()
+
+
+def create_backend():
+    if Config.MAIL_OUTBOX_BACKEND == "background":
+        return BackgroundMailBackend(
+            queue_size=Config.MAIL_OUTBOX_QUEUE_SIZE, workers=Config.MAIL_OUTBOX_WORKERS, drain_timeout=Config.MAIL_OUTBOX_DRAIN_TIMEOUT,
+        )
+    return CeleryMailBackend()
+
+
+mail_outbox = MailOutbox(create_backend())
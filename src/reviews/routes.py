@@ -1,6 +1,8 @@
-from fastapi import APIRouter, Depends, status, HTTPException
-from .service import ReviewService
-from src.db.models import User
+from fastapi import APIRouter, Depends, status, HTTPException, Request
+from fastapi.responses import Response
+from .service import ReviewService, review_etag
+from src.etag import not_modified
+from src.auth.schemas import UserPrincipal
 from src.reviews.schemas import ReviewCreateModel
 from src.db.main import get_session
 from sqlmodel.ext.asyncio.session import AsyncSession
@@ -24,10 +26,19 @@ async def get_all_reviews(session: AsyncSession = Depends(get_session)):
 # this endpoint return a review by its uid
 # when this endpoint depends on RoleChecker that means it also depends on AccessTokenBearer
 @review_router.get("/{review_uid}", dependencies=[user_role_checker])
-async def get_review_by_uid(review_uid: str, session: AsyncSession = Depends(get_session)):
+async def get_review_by_uid(review_uid: str, request: Request, response: Response, session: AsyncSession = Depends(get_session)):
+    current = await review_Service.get_review_version(review_uid, session)
+    if not current:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Review does not exist")
+    etag = review_etag(current)
+    not_modified_response = not_modified(request, etag)
+    if not_modified_response is not None:
+        return not_modified_response
+
     review = await review_Service.get_review_by_uid(review_uid, session)
     if not review:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Review does not exist")
+    response.headers["ETag"] = etag
     return review
 
 
@@ -35,7 +46,7 @@ async def get_review_by_uid(review_uid: str, session: AsyncSession = Depends(get
 @review_router.post('/book/{book_uid}', status_code=status.HTTP_201_CREATED, dependencies=[user_role_checker])
 async def add_review_to_book(book_uid: str,
                              review_data: ReviewCreateModel,
-                             current_user: User = Depends(get_current_user),
+                             current_user: UserPrincipal = Depends(get_current_user),
                              session: AsyncSession = Depends(get_session)):
 
     new_review = await review_Service.add_review_to_book(user_email=current_user.email, book_uid=book_uid, review_data=review_data, session=session)
@@ -1,6 +1,8 @@
 from src.db.models import Review
 from src.auth.service import UserService
 from src.books.service import BookService
+from src.books.cache import book_cache
+from src.etag import make_etag
 from sqlmodel.ext.asyncio.session import AsyncSession
 from .schemas import ReviewCreateModel
 from fastapi import HTTPException, status
@@ -10,6 +12,11 @@ from sqlmodel import select, desc
 book_service = BookService()
 user_service = UserService()
 
+
+# reviews can't be edited, so the uid and updated_at are enough to tell their versions apart
+def review_etag(review) -> str:
+    return make_etag("review", review.uid, review.updated_at)
+
 class ReviewService:
     async def add_review_to_book(self, user_email: str, book_uid: str, review_data: ReviewCreateModel, session: AsyncSession):
         try:
@@ -29,11 +36,14 @@ class ReviewService:
             new_review = Review(**review_data_dict) # new review is an instance of review model
 
 
-            new_review.user = user # this line fills the user_uid field
-            new_review.book = book # this line fills the book_uid field
+            # we set the foreign keys directly, assigning new_review.user would also touch user.reviews which is not loaded
+            new_review.user_uid = user.uid
+            new_review.book_uid = book.uid
 
             session.add(new_review)
+            await book_service.update_rating_aggregates(book.uid, 1, new_review.rating, session)
             await session.commit()
+            await book_cache.invalidate_books(book.uid)
 
             return new_review
 
@@ -56,12 +66,23 @@ class ReviewService:
         return review if review else None
 
 
+    # this function reads only the columns the ETag of a review is made of
+    async def get_review_version(self, review_uid: str, session: AsyncSession):
+        statement = select(Review.uid, Review.updated_at).where(Review.uid == review_uid)
+        result = await session.exec(statement)
+        return result.first()
+
+
     async def delete_review_from_book(self, review_uid: str, user_email: str ,session: AsyncSession):
         user = await user_service.get_user_by_email(email=user_email, session=session)
         review = await self.get_review_by_uid(review_uid=review_uid, session=session)
-        if not review or (review.user != user):
+        if not review or not user or (review.user_uid != user.uid):
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="cannot delete review")
 
         await session.delete(review)
+        if review.book_uid is not None:
+            await book_service.update_rating_aggregates(review.book_uid, -1, -review.rating, session)
         await session.commit()
+        if review.book_uid is not None:
+            await book_cache.invalidate_books(review.book_uid)
 
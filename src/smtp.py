@@ -0,0 +1,194 @@
+# this file sends the emails of the celery worker over smtp connections that are kept open
+# opening a connection to the mail server(and the TLS handshake and the login) takes much longer than sending one message on it
+# fastapi_mail opens a new connection for every message, so here every worker process keeps a few connections and reuses them
+#
+# the worker also groups the messages it has to send: a message waits up to SMTP_BATCH_LINGER seconds for others,
+# and then up to SMTP_BATCH_SIZE of them are sent one after the other on the same connection
+# messages only come together when the worker runs several tasks at once in one process, so start it with threads for that:
+#     celery -A src.celery_tasks.c_app worker --pool threads --concurrency 20
+# with the default prefork pool every process runs one task at a time, then each message is a batch of one but the connection is still reused
+import os
+import queue
+import smtplib
+import ssl
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from email.message import EmailMessage
+from email.utils import formataddr
+from src.config import Config
+
+
+# errors that are worth trying again later: the server is down or busy, or it answered with a 4xx(temporary) code
+# 5xx answers(like an address that doesn't exist) will fail the same way every time, so they are not retried
+class TransientMailError(Exception):
+    pass
+
+
+# the order matters: every smtplib error and every ssl error is also an OSError, and SMTPConnectError is an SMTPResponseException
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, (smtplib.SMTPException, ssl.SSLError)):
+        # the other smtp errors(like a missing extension) and the TLS errors(like a bad certificate) are problems of our setup
+        return False
+    return isinstance(error, OSError) # socket errors, like a refused connection or a timeout
+
+
+def build_message(recipients: list[str], subject: str, html: str) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = formataddr((Config.MAIL_FROM_NAME, Config.MAIL_FROM))
+    message["To"] = ", ".join(recipients)
+    message["Subject"] = subject
+    message.set_content(html, subtype="html")
+    return message
+
+
+class SMTPConnectionPool:
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._idle: queue.LifoQueue = queue.LifoQueue() # (connection, time it was last used), the most recently used one comes out first
+        self._slots = threading.BoundedSemaphore(size) # at most size connections at once, open or being used
+
+    def _connect(self) -> smtplib.SMTP:
+        context = ssl.create_default_context()
+        if not Config.VALIDATE_CERTS:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+
+        if Config.MAIL_SSL_TLS:
+            connection = smtplib.SMTP_SSL(Config.MAIL_SERVER, Config.MAIL_PORT, timeout=Config.SMTP_TIMEOUT, context=context)
+        else:
+            connection = smtplib.SMTP(Config.MAIL_SERVER, Config.MAIL_PORT, timeout=Config.SMTP_TIMEOUT)
+            if Config.MAIL_STARTTLS:
+                connection.starttls(context=context)
+        if Config.USE_CREDENTIALS:
+            connection.login(Config.MAIL_USERNAME, Config.MAIL_PASSWORD)
+        return connection
+
+    def _is_alive(self, connection: smtplib.SMTP, last_used: float) -> bool:
+        # servers close connections that have been idle for a while, so those are checked with a NOOP before being used again
+        if time.monotonic() - last_used < Config.SMTP_IDLE_CHECK:
+            return True
+        try:
+            return connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    # this function lends a connection to the caller and takes it back when the caller is done
+    # a connection that raised an error is closed instead of being given back, since we don't know what state it's in
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            connection = None
+            while connection is None:
+                try:
+                    connection, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    connection = self._connect()
+                    break
+                if not self._is_alive(connection, last_used):
+                    self._close(connection)
+                    connection = None
+
+            try:
+                yield connection
+            except BaseException:
+                self._close(connection)
+                raise
+            self._idle.put((connection, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def _close(self, connection: smtplib.SMTP) -> None:
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            connection.close()
+
+    def close(self) -> None:
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(connection)
+
+
+class MailBatcher:
+    def __init__(self, pool: SMTPConnectionPool) -> None:
+        self.pool = pool
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None # the process the sender threads belong to
+
+    # this function queues a message and returns a future that gets its result once it has been sent(or has failed)
+    def submit(self, message: EmailMessage) -> Future:
+        self._start()
+        future = Future()
+        self._queue.put((message, future))
+        return future
+
+    def send(self, message: EmailMessage) -> None:
+        self.submit(message).result()
+
+    # threads don't survive a fork, and the celery prefork pool forks its processes after importing this module
+    # so the sender threads are started by the first message of every process
+    def _start(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            for _ in range(self.pool.size):
+                threading.Thread(target=self._run, name="smtp-sender", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()] # waits for the first message of the next batch
+            deadline = time.monotonic() + Config.SMTP_BATCH_LINGER
+            while len(batch) < Config.SMTP_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._send_batch(batch)
+
+    def _send_batch(self, batch: list[tuple[EmailMessage, Future]]) -> None:
+        while batch:
+            connected = False
+            try:
+                with self.pool.connection() as connection:
+                    connected = True
+                    while batch:
+                        message, future = batch[0]
+                        try:
+                            connection.send_message(message)
+                        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as e:
+                            # the server refused this message but the connection is still fine for the next ones
+                            future.set_exception(TransientMailError(e) if is_transient(e) else e)
+                        else:
+                            future.set_result(None)
+                        batch.pop(0)
+            except Exception as e:
+                error = TransientMailError(e) if is_transient(e) else e
+                # if the connection couldn't be opened the server won't take the other messages either, so they all fail
+                # if it broke while sending, the message that was being sent fails and the rest get a new connection
+                failed = batch if not connected else batch[:1]
+                for message, future in failed:
+                    future.set_exception(error)
+                del batch[:len(failed)]
+
+
+smtp_pool = SMTPConnectionPool(size=Config.SMTP_POOL_SIZE)
+mail_batcher = MailBatcher(smtp_pool)
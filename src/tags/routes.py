@@ -1,11 +1,15 @@
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, status, Request, Query
+from fastapi.responses import Response
 from sqlmodel.ext.asyncio.session import AsyncSession
 from src.db.main import get_session
-from .schemas import TagCreateModel, TagModel, TagAddModel
-from .service import TagService
+from .schemas import TagCreateModel, TagModel, TagAddModel, TagBulkAddModel
+from .service import TagService, tag_etag
+from src.etag import not_modified, check_if_match
+from src.errors import TagNotFound
 from src.auth.dependecies import RoleChecker
 from typing import List
 from src.books.schemas import Book
+from src.config import Config
 
 tags_router = APIRouter()
 tag_service = TagService()
@@ -14,8 +18,24 @@ user_role_checker = RoleChecker(["user", "admin"])
 
 # this endpoint return all tags
 @tags_router.get("/", dependencies=[Depends(user_role_checker)], response_model=List[TagModel])
-async def get_all_tags(session: AsyncSession = Depends(get_session)):
+# clients poll this endpoint, so we answer 304 when the tags have not changed since their last request
+async def get_all_tags(request: Request, response: Response, session: AsyncSession = Depends(get_session)):
+    etag = await tag_service.get_tags_etag(session)
+    not_modified_response = not_modified(request, etag)
+    if not_modified_response is not None:
+        return not_modified_response
+
     tags = await tag_service.get_tags(session)
+    response.headers["ETag"] = etag
+    return tags
+
+
+# this endpoint suggests tags while the user is typing their name
+@tags_router.get("/suggest", dependencies=[Depends(user_role_checker)], response_model=List[TagModel])
+async def suggest_tags(q: str = Query(min_length=1, max_length=100),
+                       limit: int = Query(default=Config.SUGGEST_LIMIT, ge=1, le=Config.SUGGEST_MAX_LIMIT),
+                       session: AsyncSession = Depends(get_session)):
+    tags = await tag_service.suggest_tags(q, session, limit)
     return tags
 
 
@@ -34,9 +54,26 @@ async def add_tags_to_book(book_uid: str, tag_data: TagAddModel, session: AsyncS
     return book_with_tag
 
 
+# this endpoint adds the same tags to many books at once
+@tags_router.post("/books/tags", dependencies=[Depends(user_role_checker)])
+async def add_tags_to_books(tag_data: TagBulkAddModel, session: AsyncSession = Depends(get_session)):
+    result = await tag_service.add_tags_to_books(tag_data, session)
+    return result
+
+
 @tags_router.put("/{tag_uid}", dependencies=[Depends(user_role_checker)], response_model=TagModel)
-async def update_tag(tag_uid: str, tag_update_data: TagCreateModel, session: AsyncSession = Depends(get_session)):
-    updated_tag = await tag_service.update_tag(tag_uid, tag_update_data, session)
+# if the client sends If-Match with the ETag it has, the tag is only updated if nobody has changed it since then
+async def update_tag(tag_uid: str, tag_update_data: TagCreateModel, request: Request, response: Response, session: AsyncSession = Depends(get_session)):
+    expected_version = None
+    if "if-match" in request.headers:
+        current = await tag_service.get_tag_version(tag_uid, session)
+        if current is None:
+            raise TagNotFound()
+        check_if_match(request, tag_etag(current))
+        expected_version = current.version
+
+    updated_tag = await tag_service.update_tag(tag_uid, tag_update_data, session, expected_version=expected_version)
+    response.headers["ETag"] = tag_etag(updated_tag)
     return updated_tag
 
 # this endpoint will delete a tag
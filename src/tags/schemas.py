@@ -1,5 +1,5 @@
 import uuid
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
 from typing import List
 
@@ -13,4 +13,9 @@ class TagCreateModel(BaseModel):
     name: str
 
 class TagAddModel(BaseModel):
-    tags: List[TagCreateModel]
\ No newline at end of file
+    tags: List[TagCreateModel]
+
+# the limits keep one request from linking an unbounded number of rows, the uids are also used in IN lists
+class TagBulkAddModel(BaseModel):
+    book_uids: List[uuid.UUID] = Field(max_length=1000)
+    tags: List[TagCreateModel] = Field(max_length=50)
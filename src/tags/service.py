@@ -1,14 +1,31 @@
-from anyio import wait_writable
-
-from src.db.models import Tag
+import uuid
+from datetime import datetime
+from src.db.models import Tag, Book, BookTag
 from sqlmodel.ext.asyncio.session import AsyncSession
-from .schemas import TagCreateModel, TagAddModel
+from .schemas import TagCreateModel, TagAddModel, TagBulkAddModel, TagModel
 from src.books.service import BookService
+from src.books.utils import like_prefix, suggest_cache_key
+from src.cache import TTLLRUCache
+from src.config import Config
+from src.books.cache import book_cache
 from fastapi import HTTPException, status
-from sqlmodel import select, desc
-from src.errors import TagNotFound, BookNotFound, TagAlreadyExists
+from sqlmodel import select, desc, func
+from sqlalchemy import literal, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert
+from src.errors import TagNotFound, BookNotFound, TagAlreadyExists, PreconditionFailed
+from src.etag import make_etag
 
 book_service = BookService()
+# the results of the short prefixes typed into the tag suggest box. it is cleared when a tag of this worker changes
+tag_suggest_cache = TTLLRUCache(max_size=Config.SUGGEST_CACHE_MAX_SIZE, ttl=Config.SUGGEST_CACHE_TTL)
+# postgres accepts at most 32767 parameters in one statement and every book_tags row takes two of them
+LINK_TAGS_BATCH_SIZE = 10000
+
+
+def tag_etag(tag) -> str:
+    """The ETag of a tag, tag can be a Tag obj or the row returned by get_tag_version"""
+    return make_etag("tag", tag.uid, tag.version, tag.created_at)
 
 
 class TagService():
@@ -20,6 +37,41 @@ class TagService():
         tags = result.all()
         return tags
 
+    async def get_tags_etag(self, session: AsyncSession) -> str:
+        """Get the ETag of the list of all tags without loading the tags"""
+        # adding, renaming or deleting a tag always changes at least one of these three values
+        statement = select(func.count(Tag.uid), func.coalesce(func.sum(Tag.version), 0), func.max(Tag.created_at))
+        result = await session.exec(statement)
+        count, versions, last_created_at = result.one()
+        return make_etag("tags", count, versions, last_created_at)
+
+    async def suggest_tags(self, q: str, session: AsyncSession, limit: int):
+        """Get the tags whose name starts with q or is similar to it, for the autocomplete of the front end"""
+        q = q.strip().lower()
+        if not q: # only spaces were typed, everything would match
+            return []
+        cache_key = suggest_cache_key(q, limit)
+        if cache_key is not None:
+            tags = tag_suggest_cache.get(cache_key)
+            if tags is not None:
+                return tags
+
+        # the same matching as BookService.suggest_books, the trigram index of tags.name answers both conditions
+        is_prefix = Tag.name.ilike(like_prefix(q))
+        statement = (
+            select(Tag)
+            .where(or_(is_prefix, literal(q).op("<%")(Tag.name)))
+            .order_by(desc(is_prefix), desc(func.word_similarity(literal(q), Tag.name)), Tag.name)
+            .limit(limit)
+        )
+        result = await session.exec(statement)
+        # the cache outlives the session, so it keeps plain models instead of the Tag objects of the session
+        tags = [TagModel.model_validate(tag, from_attributes=True) for tag in result.all()]
+
+        if cache_key is not None:
+            tag_suggest_cache.set(cache_key, tags)
+        return tags
+
     async def add_tag(self, tag_data: TagCreateModel, session: AsyncSession):
         """Create a new tag"""
         statement = select(Tag).where(Tag.name == tag_data.name)
@@ -30,7 +82,9 @@ class TagService():
 
         new_tag = Tag(name=tag_data.name)
         session.add(new_tag)
+        await self._flush_tag_name(session)
         await session.commit()
+        tag_suggest_cache.clear()
         return new_tag
 
     async def add_tags_to_book(self, book_uid: str, tag_data: TagAddModel, session: AsyncSession):
@@ -39,55 +93,151 @@ class TagService():
         if not book:
             raise BookNotFound()
 
-        for tag_data in tag_data.tags:
-            statement = select(Tag).where(Tag.name == tag_data.name)
-            result = await session.exec(statement)
-            tag = result.one_or_none() # this line return a tag if it exists in the db else it would return none
-            if not tag:
-                tag = Tag(name=tag_data.name) # if the tag was not in the db we would add it to the db
-            book.tags.append(tag)
-
-        session.add(book)
+        tag_uids = await self.resolve_tags([tag.name for tag in tag_data.tags], session)
+        await self.link_tags(session, [book.uid], tag_uids)
         await session.commit()
-        await session.refresh(book)
+        await book_cache.invalidate_books(book.uid)
         return book
 
+    async def add_tags_to_books(self, tag_data: TagBulkAddModel, session: AsyncSession):
+        """Add the same tags to many books"""
+        book_uids = list(dict.fromkeys(tag_data.book_uids))
+        statement = select(Book.uid).where(Book.uid.in_(book_uids))
+        result = await session.exec(statement)
+        if len(result.all()) != len(book_uids): # at least one of the books does not exist
+            raise BookNotFound()
+
+        tag_uids = await self.resolve_tags([tag.name for tag in tag_data.tags], session)
+        links_created = await self.link_tags(session, book_uids, tag_uids)
+        await session.commit()
+        await book_cache.invalidate_books(*book_uids)
+        return {"books": len(book_uids), "links_created": links_created}
 
+    async def resolve_tags(self, names: list[str], session: AsyncSession) -> list[uuid.UUID]:
+        """Get the uids of the tags with the given names, creating the ones that don't exist"""
+        names = list(dict.fromkeys(names)) # removing duplicate names but keeping the order
+        if not names:
+            return []
 
-    async def get_tag_by_uid(self, uid: str, session: AsyncSession):
+        # one query finds all the tags that already exist
+        statement = select(Tag.uid, Tag.name).where(Tag.name.in_(names))
+        result = await session.exec(statement)
+        tag_uids = {row.name: row.uid for row in result.all()}
+
+        missing = [name for name in names if name not in tag_uids]
+        if missing:
+            # and one insert creates the missing ones
+            # if another request creates one of these tags at the same time, ON CONFLICT skips it instead of failing on the unique index of tags.name
+            statement = insert(Tag).values(
+                [{"uid": uuid.uuid4(), "name": name, "created_at": datetime.now()} for name in missing]
+            ).on_conflict_do_nothing(index_elements=["name"]).returning(Tag.uid, Tag.name)
+            result = await session.exec(statement)
+            created = {row.name: row.uid for row in result.all()}
+            tag_uids.update(created)
+            if created: # new tag names must show up in the tag suggestions, like the ones created by add_tag
+                tag_suggest_cache.clear()
+
+            # the tags that were skipped above have been created by the other request, so we read them back
+            raced = [name for name in missing if name not in tag_uids]
+            if raced:
+                statement = select(Tag.uid, Tag.name).where(Tag.name.in_(raced))
+                result = await session.exec(statement)
+                tag_uids.update({row.name: row.uid for row in result.all()})
+
+        return [tag_uids[name] for name in names]
+
+    async def link_tags(self, session: AsyncSession, book_uids: list[uuid.UUID], tag_uids: list[uuid.UUID]) -> int:
+        """Link every tag to every book, LINK_TAGS_BATCH_SIZE links per insert, and return the number of new links"""
+        if not book_uids or not tag_uids:
+            return 0
+
+        links = [{"book_id": book_uid, "tag_id": tag_uid} for book_uid in book_uids for tag_uid in tag_uids]
+        linked_book_uids = []
+        for start in range(0, len(links), LINK_TAGS_BATCH_SIZE):
+            # links that already exist are skipped by ON CONFLICT, so tagging a book with a tag it already has is not an error
+            statement = insert(BookTag).values(
+                links[start:start + LINK_TAGS_BATCH_SIZE]
+            ).on_conflict_do_nothing().returning(BookTag.book_id)
+            result = await session.exec(statement)
+            linked_book_uids.extend(result.scalars().all())
+
+        # the tags are part of the book detail, so the books that got new tags have a new version
+        if linked_book_uids:
+            await book_service.bump_versions(set(linked_book_uids), session)
+        return len(linked_book_uids)
+
+
+
+    async def get_tag_by_uid(self, uid: str, session: AsyncSession, for_update: bool = False):
         """Get tag by uid"""
         statement = select(Tag).where(Tag.uid == uid)
+        if for_update: # the row stays locked until the transaction ends
+            statement = statement.with_for_update().execution_options(populate_existing=True)
         result = await session.exec(statement)
         tag = result.first()
         return tag
 
+    async def get_tag_version(self, uid: str, session: AsyncSession):
+        """Get only the columns the ETag of a tag is made of"""
+        statement = select(Tag.uid, Tag.version, Tag.created_at).where(Tag.uid == uid)
+        result = await session.exec(statement)
+        return result.first()
+
+    async def _bump_tagged_books(self, tag_uid, session: AsyncSession):
+        """The books that have this tag show it in their detail, so they get a new version"""
+        book_uids = select(BookTag.book_id).where(BookTag.tag_id == tag_uid)
+        await book_service.bump_versions(book_uids, session)
+
 
 
-    async def update_tag(self, tag_uid: str, tag_update_data: TagCreateModel, session: AsyncSession):
+    async def update_tag(self, tag_uid: str, tag_update_data: TagCreateModel, session: AsyncSession, expected_version: int | None = None):
         """Update a tag"""
-        tag = await self.get_tag_by_uid(tag_uid, session)
+        tag = await self.get_tag_by_uid(tag_uid, session, for_update=True)
 
         if not tag:
             raise TagNotFound()
+        if expected_version is not None and tag.version != expected_version: # the tag has changed since the client fetched it
+            raise PreconditionFailed()
+
+        statement = select(Tag.uid).where(Tag.name == tag_update_data.name, Tag.uid != tag.uid)
+        result = await session.exec(statement)
+        if result.first(): # another tag already has this name
+            raise TagAlreadyExists()
 
         update_data_dict = tag_update_data.model_dump()
         for k, v in update_data_dict.items():
             setattr(tag, k, v)
+        tag.version += 1
+        await self._flush_tag_name(session)
+        await self._bump_tagged_books(tag.uid, session)
 
-            await session.commit()
-            await session.refresh(tag)
+        await session.commit()
+        await session.refresh(tag)
 
+        await book_cache.invalidate_tags()
+        tag_suggest_cache.clear()
         return tag
 
 
+    async def _flush_tag_name(self, session: AsyncSession):
+        """Write a new or renamed tag, another request can take the same name between our check and this write"""
+        try:
+            await session.flush()
+        except IntegrityError: # the unique index of tags.name
+            await session.rollback()
+            raise TagAlreadyExists()
+
     async def delete_tag(self, tag_uid: str, session: AsyncSession):
         """Delete a tag"""
         tag = await self.get_tag_by_uid(tag_uid, session)
         if not tag:
             raise TagNotFound()
 
+        await self._bump_tagged_books(tag.uid, session)
         await session.delete(tag)
         await session.commit()
+        await book_cache.invalidate_tags()
+        tag_suggest_cache.clear()
 
 
 
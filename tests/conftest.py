@@ -0,0 +1,144 @@
+# the tests run the app against a sqlite file instead of postgres, so they don't need a db server(or redis, see the client fixture)
+# run them from the root of the project with: python -m pytest
+import uuid
+from datetime import date, datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, Uuid
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.dialects.sqlite.aiosqlite import SQLiteDialect_aiosqlite
+from sqlalchemy.dialects.sqlite.pysqlite import SQLiteDialect_pysqlite
+from sqlalchemy.pool import NullPool
+from sqlmodel import SQLModel, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src import app
+from src.auth.service import user_cache
+from src.auth.utils import create_access_token
+from src.config import Config
+from src.db.main import get_session
+from src.db.models import User, Book, Review, Tag, BookTag
+
+pytest.importorskip("aiosqlite")
+
+
+# sqlite has no tsvector type and no full text search functions, the search_vector column(see src/db/models.py) is made of plain text there
+@compiles(TSVECTOR, "sqlite")
+def compile_tsvector(type_, compiler, **kw):
+    return "TEXT"
+
+
+# the routes compare uid columns with the uid strings of the url, asyncpg accepts those but the sqlite uuid type only takes uuid objects
+class SQLiteUuid(Uuid):
+    def bind_processor(self, dialect):
+        process = super().bind_processor(dialect)
+        return lambda value: process(uuid.UUID(value) if isinstance(value, str) else value)
+
+
+for dialect in (SQLiteDialect_pysqlite, SQLiteDialect_aiosqlite):
+    dialect.colspecs = {**dialect.colspecs, Uuid: SQLiteUuid}
+
+
+def add_search_functions(dbapi_connection, connection_record):
+    dbapi_connection.create_function("to_tsvector", 2, lambda config, text: text, deterministic=True)
+    dbapi_connection.create_function("setweight", 2, lambda vector, weight: vector, deterministic=True)
+
+
+# this engine creates the tables and adds the rows the tests need
+@pytest.fixture
+def sync_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'bookly.db'}")
+    event.listen(engine, "connect", add_search_functions)
+    SQLModel.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+# the sql statements the app has run, in order
+@pytest.fixture
+def queries():
+    return []
+
+
+# this is the engine the app uses. TestClient runs every request in a new event loop, so connections are not kept between requests(NullPool)
+@pytest.fixture
+def app_engine(sync_engine, queries):
+    engine = create_async_engine(sync_engine.url.set(drivername="sqlite+aiosqlite"), poolclass=NullPool)
+    event.listen(engine.sync_engine, "connect", add_search_functions)
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    yield engine
+
+
+@pytest.fixture
+def client(app_engine, monkeypatch):
+    session_factory = async_sessionmaker(bind=app_engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def test_session():
+        async with session_factory() as session:
+            yield session
+
+    async def not_revoked(jti):
+        return False
+
+    # there is no redis in the tests: the book cache is off and no token is revoked
+    monkeypatch.setattr(Config, "BOOK_CACHE_ENABLED", False)
+    monkeypatch.setattr("src.auth.dependecies.token_in_blocklist", not_revoked)
+    user_cache.clear()
+    app.dependency_overrides[get_session] = test_session
+    yield TestClient(app, base_url="http://localhost")
+    app.dependency_overrides.clear()
+    user_cache.clear()
+
+
+@pytest.fixture
+def user(sync_engine):
+    user = User(
+        username="reader", email="reader@example.com", first_name="Book", last_name="Reader",
+        role="user", is_verified=True, password_hash="not-used",
+    )
+    with Session(sync_engine, expire_on_commit=False) as session:
+        session.add(user)
+        session.commit()
+    return user
+
+
+@pytest.fixture
+def auth_headers(user):
+    token = create_access_token(user_data={"email": user.email, "user_uid": str(user.uid), "role": user.role})
+    return {"Authorization": f"Bearer {token}"}
+
+
+# this function adds count books of user, every book has two reviews and two tags
+@pytest.fixture
+def add_books(sync_engine, user):
+    tag_names = iter(range(1_000_000))
+
+    def add(count: int, **fields) -> list[Book]:
+        books = []
+        with Session(sync_engine, expire_on_commit=False) as session:
+            for i in range(count):
+                book = Book(
+                    uid=uuid.uuid4(), title=fields.get("title", f"Book {i}"), author=fields.get("author", "Author"), publisher="Publisher",
+                    published_date=date(2000, 1, 1) + timedelta(days=i), page_count=100, language=fields.get("language", "en"),
+                    user_uid=user.uid, review_count=2, rating_sum=7, average_rating=3.5,
+                    created_at=datetime(2024, 1, 1) + timedelta(minutes=i), updated_at=datetime(2024, 1, 1),
+                )
+                session.add(book)
+                for rating in (3, 4):
+                    session.add(Review(rating=rating, review_text="ok", user_uid=user.uid, book_uid=book.uid))
+                for _ in range(2):
+                    tag = Tag(uid=uuid.uuid4(), name=f"tag-{next(tag_names)}")
+                    session.add(tag)
+                    session.add(BookTag(book_id=book.uid, tag_id=tag.uid))
+                books.append(book)
+            session.commit()
+        return books
+
+    return add
@@ -0,0 +1,53 @@
+# one authenticated request decodes its token once, checks the blocklist once and looks the user up at most once,
+# even though the book routes depend on access_token_bearer directly and through RoleChecker and get_current_user
+import src.auth.dependecies as dependencies
+
+
+def test_token_is_checked_once_per_request(client, queries, auth_headers, add_books, monkeypatch):
+    add_books(1)
+    decoded, checked = [], []
+    decode_token = dependencies.decode_token
+
+    def counting_decode(token):
+        decoded.append(token)
+        return decode_token(token)
+
+    async def counting_check(jti):
+        checked.append(jti)
+        return False
+
+    monkeypatch.setattr(dependencies, "decode_token", counting_decode)
+    monkeypatch.setattr(dependencies, "token_in_blocklist", counting_check)
+
+    response = client.get("/api/v1/books/", headers=auth_headers)
+    assert response.status_code == 200
+    assert len(decoded) == 1
+    assert len(checked) == 1
+    assert sum("FROM users" in statement for statement in queries) == 1
+
+
+def test_user_comes_from_the_cache_after_the_first_request(client, queries, auth_headers, add_books):
+    add_books(1)
+    client.get("/api/v1/books/", headers=auth_headers)
+    queries.clear()
+    response = client.get("/api/v1/books/", headers=auth_headers)
+    assert response.status_code == 200
+    assert not any("FROM users" in statement for statement in queries)
+
+
+def test_revoked_token_is_rejected(client, auth_headers, monkeypatch):
+    async def revoked(jti):
+        return True
+
+    monkeypatch.setattr(dependencies, "token_in_blocklist", revoked)
+    response = client.get("/api/v1/books/", headers=auth_headers)
+    assert response.status_code == 403
+    assert response.json()["error_code"] == "invalid_token"
+
+
+def test_unverified_user_is_rejected(client, auth_headers, user, sync_engine):
+    with sync_engine.begin() as connection:
+        connection.exec_driver_sql("UPDATE users SET is_verified = 0")
+    response = client.get("/api/v1/books/", headers=auth_headers)
+    assert response.status_code == 403
+    assert response.json()["error_code"] == "account_not_verified"
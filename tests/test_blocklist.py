@@ -0,0 +1,116 @@
+import asyncio
+import fnmatch
+import time
+import pytest
+import src.db.redis as blocklist
+from src.db.redis import RevokedTokens, BLOCKLIST_KEY, BLOCKLIST_MIGRATED_KEY
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.keys = {} # key -> time it expires at, or None
+        self.sorted_sets = {}
+        self.published = []
+        self.scans = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def exists(self, *keys):
+        return sum(key in self.keys for key in keys)
+
+    async def set(self, key, value, ex=None):
+        self.keys[key] = time.time() + ex if ex else None
+
+    async def pttl(self, key):
+        key = key.decode()
+        if key not in self.keys:
+            return -2
+        return -1 if self.keys[key] is None else int((self.keys[key] - time.time()) * 1000)
+
+    async def scan_iter(self, match, count):
+        self.scans += 1
+        for key in list(self.keys):
+            if fnmatch.fnmatchcase(key, match):
+                yield key.encode()
+
+    async def zadd(self, key, mapping):
+        self.sorted_sets.setdefault(key, {}).update(mapping)
+
+    async def zremrangebyscore(self, key, low, high):
+        self.sorted_sets[key] = {member: score for member, score in self.sorted_sets.get(key, {}).items() if score > high}
+
+    async def zrangebyscore(self, key, low, high, withscores):
+        return [(member.encode(), score) for member, score in self.sorted_sets.get(key, {}).items() if score >= low]
+
+    async def zscore(self, key, member):
+        return self.sorted_sets.get(key, {}).get(member)
+
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis) -> None:
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    async def execute(self):
+        return [await getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(blocklist, "get_redis", lambda: redis)
+    monkeypatch.setattr(blocklist, "revoked_tokens", RevokedTokens())
+    return redis
+
+
+def test_revoked_tokens_are_kept_until_they_expire(redis):
+    async def run():
+        await blocklist.add_jti_to_blocklist("fresh", time.time() + 60)
+        await blocklist.add_jti_to_blocklist("expired", time.time() - 1)
+        return await blocklist.token_in_blocklist("fresh"), await blocklist.token_in_blocklist("expired"), await blocklist.token_in_blocklist("other")
+
+    assert asyncio.run(run()) == (True, False, False)
+    assert set(redis.sorted_sets[BLOCKLIST_KEY]) == {"fresh"} # the expired jti is trimmed by the next revocation
+    assert [message.partition(":")[0] for _, message in redis.published] == ["fresh", "expired"]
+
+
+def test_resync_reads_the_sorted_set_without_scanning(redis):
+    redis.sorted_sets[BLOCKLIST_KEY] = {"a": time.time() + 60, "b": time.time() - 60}
+    tokens = RevokedTokens()
+    asyncio.run(tokens.resync())
+    assert "a" in tokens and "b" not in tokens
+    assert redis.scans == 0
+
+
+def test_legacy_keys_are_migrated_once(redis):
+    first, second = "11111111-1111-1111-1111-111111111111", "22222222-2222-2222-2222-222222222222"
+    asyncio.run(redis.set(first, "", ex=100))
+    asyncio.run(redis.set(second, ""))
+    asyncio.run(redis.set("blocklist:unrelated", ""))
+
+    asyncio.run(blocklist.migrate_legacy_blocklist())
+    assert set(redis.sorted_sets[BLOCKLIST_KEY]) == {first, second}
+    assert BLOCKLIST_MIGRATED_KEY in redis.keys
+    assert first in redis.keys # copied, not moved
+
+    scans = redis.scans
+    asyncio.run(blocklist.migrate_legacy_blocklist())
+    assert redis.scans == scans
+
+
+def test_legacy_keys_are_checked_before_the_migration(redis):
+    asyncio.run(redis.set("33333333-3333-3333-3333-333333333333", "", ex=100))
+    assert asyncio.run(blocklist.token_in_blocklist("33333333-3333-3333-3333-333333333333"))
@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+from sqlmodel.ext.asyncio.session import AsyncSession
+import src.books.cache
+import src.books.service
+from src.books.cache import BookCache
+from src.books.service import BookService
+from src.config import Config
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.data = {}
+        self.calls = []
+
+    async def mget(self, keys):
+        self.calls.append("mget")
+        return [self.data.get(key) for key in keys]
+
+    async def get(self, key):
+        self.calls.append("get")
+        return self.data.get(key)
+
+    async def set(self, key, value, nx=False, px=None, ex=None):
+        self.calls.append("set")
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis) -> None:
+        self.redis = redis
+        self.keys = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def incr(self, key):
+        self.keys.append(key)
+
+    async def execute(self):
+        self.redis.calls.append("pipeline")
+        for key in self.keys:
+            self.redis.data[key] = int(self.redis.data.get(key, 0)) + 1
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(src.books.cache, "get_redis", lambda: redis)
+    monkeypatch.setattr(Config, "BOOK_CACHE_ENABLED", True)
+    return redis
+
+
+# when the invalidation after a write is lost(redis down, breaker open), the version counters in redis don't change
+# the payload cached for the old row must still not be served with the ETag of the new one
+def test_detail_is_cached_per_etag(redis):
+    cache = BookCache()
+
+    async def run():
+        old = await cache.get_book_detail("b1", '"v1"', lambda: asyncio.sleep(0, "old body"))
+        cached = await cache.get_book_detail("b1", '"v1"', lambda: asyncio.sleep(0, "not loaded"))
+        new = await cache.get_book_detail("b1", '"v2"', lambda: asyncio.sleep(0, "new body"))
+        return old, cached, new
+
+    assert asyncio.run(run()) == ("old body", "old body", "new body")
+
+
+def test_invalidation_skips_redis_when_the_cache_is_off(redis, monkeypatch):
+    monkeypatch.setattr(Config, "BOOK_CACHE_ENABLED", False)
+    asyncio.run(BookCache().invalidate_books("b1"))
+    assert redis.calls == []
+
+
+def test_recompute_invalidates_the_fixed_books(app_engine, sync_engine, add_books, monkeypatch):
+    books = add_books(3) # every book says it has two reviews with a sum of 7, which is right
+    with sync_engine.begin() as connection:
+        connection.exec_driver_sql(f"UPDATE books SET review_count = 5 WHERE uid = '{books[1].uid.hex}'")
+        connection.exec_driver_sql(f"DELETE FROM reviews WHERE book_uid = '{books[2].uid.hex}'")
+    invalidated = []
+
+    async def invalidate_books(*book_uids):
+        invalidated.extend(book_uids)
+
+    monkeypatch.setattr(src.books.service.book_cache, "invalidate_books", invalidate_books)
+
+    async def run():
+        async with AsyncSession(app_engine) as session:
+            return await BookService().recompute_rating_aggregates(session)
+
+    fixed = asyncio.run(run())
+    assert sorted(fixed) == sorted(invalidated) == sorted([books[1].uid, books[2].uid])
+    with sync_engine.connect() as connection:
+        counts = dict(connection.exec_driver_sql("SELECT uid, review_count FROM books").all())
+    assert counts[books[1].uid.hex] == 2 and counts[books[2].uid.hex] == 0
@@ -0,0 +1,86 @@
+import asyncio
+import json
+from src.books.utils import iter_lines, iter_ndjson_rows, iter_csv_rows
+from src.books import service
+from src.config import Config
+
+
+# the body arrives in chunks of any size, these tests cut it in the worst places
+async def chunked(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def collect(rows) -> list:
+    async def run():
+        return [row async for row in rows]
+    return asyncio.run(run())
+
+
+def test_lines_split_across_chunks_and_utf8_characters():
+    data = "first\r\nsécond line\nlast".encode()
+    for size in (1, 2, 3, 7, len(data)):
+        assert collect(iter_lines(chunked(data, size))) == ["first", "sécond line", "last"]
+
+
+def test_ndjson_rows_and_errors():
+    data = b'{"title": "a"}\n\nnot json\n[1, 2]\n{"title": "b"}'
+    rows = collect(iter_ndjson_rows(chunked(data, 4)))
+    assert rows[0] == {"title": "a"} and rows[3] == {"title": "b"}
+    assert rows[1].startswith("invalid json")
+    assert rows[2] == "the row must be a json object"
+
+
+def test_csv_rows_with_quoted_newlines_and_commas():
+    data = 'title,author\n"Hello, World","multi\nline"\nplain,row\n'.encode()
+    rows = collect(iter_csv_rows(chunked(data, 5)))
+    assert rows == [{"title": "Hello, World", "author": "multi\nline"}, {"title": "plain", "author": "row"}]
+
+
+def test_csv_row_errors():
+    data = b'title,author\nonly one\n"never closed,x\n'
+    rows = collect(iter_csv_rows(chunked(data, 3)))
+    assert rows == ["expected 2 fields but got 1", "the last row has an unclosed quote"]
+
+
+BOOK = {"title": "T", "author": "A", "publisher": "P", "published_date": "2020-01-02", "page_count": 10, "language": "en"}
+
+
+def test_bulk_import_inserts_in_batches_and_reports_row_errors(client, queries, auth_headers, monkeypatch):
+    monkeypatch.setattr(Config, "BOOK_IMPORT_BATCH_SIZE", 2)
+    lines = [json.dumps({**BOOK, "title": f"Book {i}"}) for i in range(5)]
+    lines.insert(2, json.dumps({**BOOK, "published_date": "02/01/2020"}))
+    lines.insert(4, json.dumps({"title": "missing fields"}))
+    body = "\n".join(lines).encode()
+
+    response = client.post("/api/v1/books/bulk", content=body, headers={**auth_headers, "Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert result["inserted"] == 5 and result["failed"] == 2
+    assert [error["row"] for error in result["errors"]] == [3, 5]
+    assert sum(statement.startswith("INSERT INTO books") for statement in queries) == 3 # 2 + 2 + 1 books
+
+    page = client.get("/api/v1/books/?limit=10", headers=auth_headers).json()
+    assert sorted(book["title"] for book in page["items"]) == [f"Book {i}" for i in range(5)]
+
+
+def test_bulk_import_csv(client, auth_headers):
+    body = "title,author,publisher,published_date,page_count,language\nT,A,P,2020-01-02,10,en\n".encode()
+    response = client.post("/api/v1/books/bulk", content=body, headers={**auth_headers, "Content-Type": "text/csv"})
+    assert response.json() == {"inserted": 1, "failed": 0, "errors": []}
+
+
+def test_bulk_import_rejects_other_content_types(client, auth_headers):
+    response = client.post("/api/v1/books/bulk", content=b"<books/>", headers={**auth_headers, "Content-Type": "application/xml"})
+    assert response.status_code == 415
+
+
+def test_bulk_import_batches_stay_under_the_parameter_limit(client, queries, auth_headers, monkeypatch):
+    assert service.BOOK_IMPORT_MAX_BATCH_SIZE * len(service.Book.__table__.columns) <= 32767
+    monkeypatch.setattr(Config, "BOOK_IMPORT_BATCH_SIZE", 100_000)
+    monkeypatch.setattr(service, "BOOK_IMPORT_MAX_BATCH_SIZE", 2)
+    body = "\n".join(json.dumps({**BOOK, "title": f"Book {i}"}) for i in range(5)).encode()
+
+    response = client.post("/api/v1/books/bulk", content=body, headers={**auth_headers, "Content-Type": "application/x-ndjson"})
+    assert response.json()["inserted"] == 5
+    assert sum(statement.startswith("INSERT INTO books") for statement in queries) == 3
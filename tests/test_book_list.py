@@ -0,0 +1,113 @@
+import uuid
+from datetime import date, datetime
+import pytest
+from src.books.utils import encode_cursor, decode_cursor
+from src.db.models import Book
+from src.errors import InvalidCursor
+
+
+@pytest.mark.parametrize("sort, value", [
+    ("created_at", datetime(2024, 5, 1, 12, 30, 15, 250)),
+    ("published_date", date(1999, 12, 31)),
+    ("title", "Dune"),
+    ("rating", 4.25),
+    ("rank", 0.0607927),
+])
+def test_cursor_round_trip(sort, value):
+    uid = uuid.uuid4()
+    assert decode_cursor(encode_cursor(sort, value, uid), sort) == (value, uid)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64 at all!",
+    encode_cursor("title", "Dune", uuid.uuid4()), # a cursor of another sort
+    encode_cursor("created_at", "yesterday", uuid.uuid4()),
+    encode_cursor("created_at", "2024-01-01T00:00:00", "not-a-uuid"),
+])
+def test_bad_cursors_are_rejected(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor, "created_at")
+
+
+def test_bad_cursor_is_a_400(client, auth_headers):
+    response = client.get("/api/v1/books/", params={"cursor": "garbage"}, headers=auth_headers)
+    assert response.status_code == 400
+
+
+def read_all_pages(client, headers, url="/api/v1/books/", **params) -> list[dict]:
+    books, cursor = [], None
+    while True:
+        response = client.get(url, params={**params, "limit": 2, **({"cursor": cursor} if cursor else {})}, headers=headers)
+        assert response.status_code == 200, response.text
+        page = response.json()
+        books += page["items"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return books
+
+
+# every book of add_books has the same rating, so sorting by rating only works if the uid breaks the ties on every page
+@pytest.mark.parametrize("sort, key, reverse", [
+    ("created_at", lambda book: (book["created_at"], book["uid"]), True),
+    ("published_date", lambda book: (book["published_date"], book["uid"]), True),
+    ("title", lambda book: (book["title"], book["uid"]), False),
+    ("rating", lambda book: (book["average_rating"], book["uid"]), True),
+])
+def test_pages_cover_every_book_once_in_order(client, auth_headers, add_books, sort, key, reverse):
+    add_books(7)
+    books = read_all_pages(client, auth_headers, sort=sort)
+    assert len(books) == 7 and len({book["uid"] for book in books}) == 7
+    assert books == sorted(books, key=key, reverse=reverse)
+
+
+def test_user_books_pages(client, auth_headers, user, add_books):
+    add_books(5)
+    assert len(read_all_pages(client, auth_headers, f"/api/v1/books/user/{user.uid}")) == 5
+    assert read_all_pages(client, auth_headers, f"/api/v1/books/user/{uuid.uuid4()}") == []
+
+
+def test_filters(client, auth_headers, add_books, sync_engine):
+    english = add_books(3)
+    french = add_books(2, language="fr", author="Hugo")
+    with sync_engine.begin() as connection:
+        connection.exec_driver_sql(f"UPDATE books SET average_rating = 5 WHERE uid = '{english[0].uid.hex}'")
+
+    def uids(**params):
+        return {book["uid"] for book in read_all_pages(client, auth_headers, **params)}
+
+    assert uids(language="fr") == {str(book.uid) for book in french}
+    assert uids(author="Hugo", sort="title") == {str(book.uid) for book in french}
+    assert uids(min_rating=4.5) == {str(english[0].uid)}
+    # add_books gives the i-th book of every call the date 2000-01-01 plus i days
+    assert uids(published_after="2000-01-02", published_before="2000-01-02") == {str(english[1].uid), str(french[1].uid)}
+    with sync_engine.connect() as connection:
+        tag = connection.exec_driver_sql(f"SELECT tags.name FROM tags JOIN booktag ON booktag.tag_id = tags.uid WHERE booktag.book_id = '{french[0].uid.hex}'").first()[0]
+    assert uids(tag=tag) == {str(french[0].uid)}
+
+
+def test_filter_values_are_validated(client, auth_headers, add_books):
+    add_books(1)
+    response = client.get("/api/v1/books/", params={"min_rating": 6}, headers=auth_headers)
+    assert response.status_code == 422
+
+
+# the planner can only read a page straight from an index when an index starts with the filter columns and then the sort key and uid
+# the plans themselves need postgres, this checks that every supported order and its equality filters have such an index
+def index_columns() -> set[tuple]:
+    return {
+        tuple(expression.element.name if hasattr(expression, "element") else expression.name for expression in index.expressions)
+        for index in Book.__table__.indexes
+    }
+
+
+@pytest.mark.parametrize("columns", [
+    ("created_at", "uid"),
+    ("published_date", "uid"),
+    ("title", "uid"),
+    ("average_rating", "uid"),
+    ("user_uid", "created_at", "uid"),
+    ("language", "created_at", "uid"),
+    ("author", "created_at", "uid"),
+])
+def test_sorts_have_an_index(columns):
+    assert columns in index_columns()
@@ -0,0 +1,87 @@
+import asyncio
+import pytest
+from sqlmodel.ext.asyncio.session import AsyncSession
+import src.cache
+from src.cache import TTLLRUCache
+from src.auth.service import UserService, user_cache
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(src.cache.time, "monotonic", clock)
+    return clock
+
+
+def test_get_counts_hits_and_misses(clock):
+    cache = TTLLRUCache(max_size=10, ttl=60)
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = TTLLRUCache(max_size=10, ttl=60)
+    cache.set("a", 1)
+    clock.now += 59
+    assert cache.get("a") == 1
+    clock.now += 2
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = TTLLRUCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a") # now b is the least recently used one
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_set_again_refreshes_the_entry(clock):
+    cache = TTLLRUCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    clock.now += 50
+    cache.set("a", 2)
+    clock.now += 50
+    assert cache.get("a") == 2
+
+
+def test_invalidate_and_clear(clock):
+    cache = TTLLRUCache(max_size=10, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.invalidate("a")
+    cache.invalidate("missing")
+    assert cache.get("a") is None and cache.get("b") == 2
+    cache.clear()
+    assert cache.stats()["size"] == 0
+
+
+def test_update_user_invalidates_the_cached_principal(app_engine, user):
+    async def run():
+        service = UserService()
+        async with AsyncSession(app_engine, expire_on_commit=False) as session:
+            assert (await service.get_user_principal(user.email, session)).role == "user"
+            db_user = await service.get_user_by_email(user.email, session)
+            await service.update_user(db_user, {"role": "admin"}, session)
+            assert user_cache.get(user.email) is None
+            assert (await service.get_user_principal(user.email, session)).role == "admin"
+
+    user_cache.clear()
+    try:
+        asyncio.run(run())
+    finally:
+        user_cache.clear()
@@ -0,0 +1,76 @@
+import asyncio
+import pytest
+from celery import states
+import src.celery_tasks as tasks
+import src.outbox as outbox
+from src.outbox import BackgroundMailBackend, CeleryMailBackend, read_task_metas
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+    monkeypatch.setattr(tasks.c_app.conf, "task_always_eager", True)
+    monkeypatch.setattr(tasks.mail_batcher, "send", sent.append)
+    return sent
+
+
+# send_email tasks queued by the previous release carry the rendered html, the new workers must still send them
+def test_send_email_keeps_the_old_signature(sent):
+    tasks.send_email.delay(["reader@example.com"], "Hello", "<p>hi</p>")
+    assert len(sent) == 1
+    assert sent[0]["To"] == "reader@example.com" and sent[0]["Subject"] == "Hello"
+    assert "<p>hi</p>" in sent[0].get_body(("html",)).get_content()
+
+
+def test_the_outbox_enqueues_the_templated_task(monkeypatch):
+    calls = []
+    monkeypatch.setattr(tasks.send_templated_email, "delay", lambda *args: calls.append(args))
+    asyncio.run(CeleryMailBackend().enqueue(["reader@example.com"], "Welcome", "welcome.html", {"first_name": "Book"}))
+    assert calls == [(["reader@example.com"], "Welcome", "welcome.html", {"first_name": "Book"})]
+
+
+class FakeResultBackend:
+    def __init__(self, backend, metas: dict) -> None:
+        self.backend = backend
+        self.stored = {backend.get_key_for_task(task_id): backend.encode(meta) for task_id, meta in metas.items()}
+        self.mget_calls = 0
+
+    def mget(self, keys):
+        self.mget_calls += 1
+        return [self.stored.get(key) for key in keys]
+
+
+def test_chunk_states_are_read_in_one_call(monkeypatch):
+    backend = tasks.c_app.backend
+    fake = FakeResultBackend(backend, {
+        "a": {"status": states.SUCCESS, "result": 500},
+        "b": {"status": states.SUCCESS, "result": 120},
+        "c": {"status": states.RETRY, "result": None},
+    })
+    monkeypatch.setattr(backend, "mget", fake.mget)
+    metas = read_task_metas(backend, ["a", "b", "c", "d"])
+    assert fake.mget_calls == 1
+    assert [meta["status"] for meta in metas] == [states.SUCCESS, states.SUCCESS, states.RETRY, states.PENDING]
+    assert sum(meta["result"] for meta in metas if meta["status"] == states.SUCCESS) == 620
+
+
+def test_background_outbox_stops_when_the_mail_server_hangs(monkeypatch, caplog):
+    class HangingMail:
+        async def send_message(self, message):
+            await asyncio.Event().wait()
+
+    monkeypatch.setattr(outbox, "mail", HangingMail())
+    monkeypatch.setattr(outbox, "load_templates", lambda: None)
+    monkeypatch.setattr(outbox, "render_email", lambda template, context, recipient: "<p>hi</p>")
+
+    async def run():
+        backend = BackgroundMailBackend(queue_size=10, workers=1, drain_timeout=0.1)
+        await backend.start()
+        for _ in range(3):
+            await backend.enqueue(["reader@example.com"], "Hello", "welcome", {})
+        await asyncio.wait_for(backend.stop(), timeout=5)
+        return backend
+
+    backend = asyncio.run(run())
+    assert backend._tasks == []
+    assert "2 queued emails have been dropped" in caplog.text # the first one was being sent
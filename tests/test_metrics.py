@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+
+def test_requests_are_counted_by_route_template(client, auth_headers, add_books):
+    book = add_books(1)[0]
+    client.get(f"/api/v1/books/{book.uid}", headers=auth_headers)
+    client.get("/no/such/page")
+
+    body = client.get("/metrics").text
+    assert 'http_requests_total{method="GET",route="/api/v1/books/{book_uid}",status="200"}' in body
+    assert 'route="unmatched"' in body
+    assert str(book.uid) not in body # the real paths must not become labels
+    assert "db_pool_checkouts_total" in body and "password_hash_queued" in body
+
+
+# the multiprocess mode is chosen when prometheus_client is imported, so the workers are new interpreters with PROMETHEUS_MULTIPROC_DIR set
+# the first one exits without being marked dead, like a crashed worker, and the second one scrapes before and after marking it dead
+DEAD_WORKER = """
+import os
+from src.metrics import DB_POOL_IN_USE, REDIS_CIRCUIT_OPEN
+DB_POOL_IN_USE.set(5)
+REDIS_CIRCUIT_OPEN.set(1)
+print(os.getpid())
+"""
+
+LIVE_WORKER = """
+import sys
+from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+from src.metrics import DB_POOL_IN_USE, REDIS_CIRCUIT_OPEN, mark_process_dead
+
+def scrape():
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry).decode()
+
+DB_POOL_IN_USE.set(2)
+before = scrape()
+mark_process_dead(int(sys.argv[1]))
+after = scrape()
+assert "db_pool_connections_in_use 7.0" in before and "redis_circuit_open 1.0" in before, before
+assert "db_pool_connections_in_use 2.0" in after and "redis_circuit_open 0.0" in after, after
+"""
+
+
+def test_gauges_of_dead_workers_are_dropped(tmp_path):
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+    dead = subprocess.run([sys.executable, "-c", DEAD_WORKER], env=env, capture_output=True, text=True, check=True)
+    live = subprocess.run([sys.executable, "-c", LIVE_WORKER, dead.stdout.strip()], env=env, capture_output=True, text=True)
+    assert live.returncode == 0, live.stderr
@@ -0,0 +1,26 @@
+# the alembic autogenerate compares the migrations with these models, so everything the migrations create must be declared here
+from sqlalchemy import Computed, insert
+from sqlalchemy.dialects import postgresql
+from sqlmodel import select
+from src.db.models import Book, Tag
+
+
+def test_search_vector_is_in_the_metadata_but_never_loaded():
+    column = Book.__table__.c.search_vector
+    assert isinstance(column.computed, Computed) and column.computed.persisted
+    assert "search_vector" not in Book.__mapper__.columns
+    assert "search_vector" not in str(select(Book).compile(dialect=postgresql.dialect()))
+    assert "search_vector" not in str(insert(Book).values(title="t").compile(dialect=postgresql.dialect()))
+
+
+def test_search_vector_has_a_gin_index():
+    index = next(index for index in Book.__table__.indexes if index.name == "ix_books_search_vector")
+    assert index.dialect_options["postgresql"]["using"] == "gin"
+    assert [column.name for column in index.columns] == ["search_vector"]
+
+
+def test_trigram_indexes_are_declared():
+    indexes = {index.name: index for table in (Book.__table__, Tag.__table__) for index in table.indexes}
+    for name, column in (("ix_books_title_trgm", "title"), ("ix_books_author_trgm", "author"), ("ix_tags_name_trgm", "name")):
+        options = indexes[name].dialect_options["postgresql"]
+        assert options["using"] == "gin" and options["ops"] == {column: "gin_trgm_ops"}
@@ -0,0 +1,46 @@
+# a login storm must not stall the other requests of the worker: bcrypt runs in the thread pool and the event loop keeps going
+# this is the load test in small: while more hashes than PASSWORD_HASH_WORKERS are running, a ticker on the event loop must keep its pace
+import asyncio
+import time
+from src.auth import utils
+from src.config import Config
+
+
+def test_hashing_does_not_block_the_event_loop():
+    async def run():
+        stop = False
+        lags = []
+        max_running = 0
+
+        async def ticker():
+            while not stop:
+                start = time.perf_counter()
+                await asyncio.sleep(0.005)
+                lags.append(time.perf_counter() - start - 0.005)
+
+        async def watch_running():
+            nonlocal max_running
+            while not stop:
+                max_running = max(max_running, utils.passwd_hash_stats.running)
+                await asyncio.sleep(0.001)
+
+        tasks = [asyncio.create_task(ticker()), asyncio.create_task(watch_running())]
+        hashes = await asyncio.gather(*(utils.generate_passwd_hash_async(f"password-{i}") for i in range(Config.PASSWORD_HASH_WORKERS * 2)))
+        stop = True
+        await asyncio.gather(*tasks)
+        return hashes, lags, max_running
+
+    hashes, lags, max_running = asyncio.run(run())
+    assert utils.verify_passwd_hash("password-0", hashes[0])
+    assert max_running <= Config.PASSWORD_HASH_WORKERS
+    assert utils.passwd_hash_stats.queued == 0 and utils.passwd_hash_stats.running == 0
+    # one bcrypt hash takes far longer than this, so the loop would miss it many times over if hashing ran on it
+    assert sorted(lags)[int(len(lags) * 0.99)] < 0.05
+
+
+def test_verify_async():
+    async def run():
+        hashed = await utils.generate_passwd_hash_async("secret-password")
+        return await utils.verify_passwd_hash_async("secret-password", hashed), await utils.verify_passwd_hash_async("wrong", hashed)
+
+    assert asyncio.run(run()) == (True, False)
@@ -0,0 +1,65 @@
+# every endpoint states the relationships it needs and everything else is lazy="raise"(see src/db/loaders.py)
+# these tests count the sql statements of the book endpoints, so a relationship that starts loading per book(N+1) or
+# a relationship loaded where it's not needed makes them fail. the number must not grow with the number of books
+import contextvars
+import pytest
+from sqlalchemy.exc import OperationalError
+from src.db.instrumentation import instrument_engine, start_request_stats
+
+
+def count_queries(client, queries, url, headers) -> list[str]:
+    client.get(url, headers=headers) # the first request also looks the user up, the next ones get it from user_cache
+    queries.clear()
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200, response.text
+    return list(queries)
+
+
+@pytest.mark.parametrize("book_count", [1, 5])
+def test_book_list(client, queries, auth_headers, add_books, book_count):
+    add_books(book_count)
+    statements = count_queries(client, queries, "/api/v1/books/", auth_headers)
+    assert len(statements) == 1 # the page itself, the list has no relationships
+    assert "reviews" not in statements[0] and "tags" not in statements[0]
+
+
+@pytest.mark.parametrize("book_count", [1, 5])
+def test_user_book_list(client, queries, auth_headers, user, add_books, book_count):
+    add_books(book_count)
+    statements = count_queries(client, queries, f"/api/v1/books/user/{user.uid}", auth_headers)
+    assert len(statements) == 1
+
+
+def test_book_detail(client, queries, auth_headers, add_books):
+    book = add_books(3)[0]
+    statements = count_queries(client, queries, f"/api/v1/books/{book.uid}", auth_headers)
+    # the version for the ETag, the book, and one query for each of its relationships(reviews and tags)
+    assert len(statements) == 4
+    relationships = statements[2:]
+    assert any("FROM reviews" in statement for statement in relationships)
+    assert any("JOIN tags" in statement for statement in relationships)
+
+
+def test_book_detail_not_modified(client, queries, auth_headers, add_books):
+    book = add_books(1)[0]
+    etag = client.get(f"/api/v1/books/{book.uid}", headers=auth_headers).headers["ETag"]
+    queries.clear()
+    response = client.get(f"/api/v1/books/{book.uid}", headers={**auth_headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert len(queries) == 1 # only the version is read
+
+
+
+def test_failed_statements_are_not_timed(sync_engine):
+    def run():
+        instrument_engine(sync_engine)
+        stats = start_request_stats()
+        with sync_engine.connect() as conn:
+            with pytest.raises(OperationalError):
+                conn.exec_driver_sql("SELECT * FROM missing")
+            conn.exec_driver_sql("SELECT 1")
+            assert not conn.info # nothing of the failed statement is left on the connection
+        return stats
+
+    stats = contextvars.copy_context().run(run) # the stats of this test don't leak into the next ones
+    assert stats.count == 1 and stats.statements["SELECT 1"] == 1
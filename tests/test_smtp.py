@@ -0,0 +1,23 @@
+import smtplib
+import socket
+import ssl
+import pytest
+from src.smtp import is_transient
+
+
+@pytest.mark.parametrize("error, transient", [
+    (smtplib.SMTPServerDisconnected("gone"), True),
+    (smtplib.SMTPConnectError(554, "no service"), True),
+    (smtplib.SMTPResponseException(451, "try again later"), True),
+    (smtplib.SMTPResponseException(550, "no such user"), False),
+    (smtplib.SMTPRecipientsRefused({"a@example.com": (450, b"busy"), "b@example.com": (451, b"busy")}), True),
+    (smtplib.SMTPRecipientsRefused({"a@example.com": (450, b"busy"), "b@example.com": (550, b"unknown")}), False),
+    (smtplib.SMTPNotSupportedError("no STARTTLS"), False),
+    (smtplib.SMTPException("No suitable authentication method found"), False),
+    (ssl.SSLCertVerificationError("certificate verify failed"), False),
+    (ConnectionRefusedError(), True),
+    (socket.timeout(), True),
+    (ValueError("bad message"), False),
+])
+def test_is_transient(error, transient):
+    assert is_transient(error) is transient
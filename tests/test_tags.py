@@ -0,0 +1,92 @@
+import asyncio
+import uuid
+import pytest
+from sqlalchemy.engine.result import IteratorResult, SimpleResultMetaData
+from pydantic import ValidationError
+from sqlmodel import Session, select
+from src.db.models import Tag
+from src.tags import service
+from src.tags.schemas import TagBulkAddModel
+from src.tags.service import TagService, LINK_TAGS_BATCH_SIZE
+
+
+# link_tags and resolve_tags use postgres only inserts(ON CONFLICT ... RETURNING), so this session records the statements instead of running them
+# the results are real Result objects made of rows, like the ones the driver returns
+def make_result(columns: list[str], rows: list[tuple]):
+    metadata = SimpleResultMetaData(columns)
+    return IteratorResult(metadata, iter(rows))
+
+
+class FakeSession:
+    def __init__(self, results) -> None:
+        self.results = iter(results)
+        self.statements = []
+
+    async def exec(self, statement):
+        self.statements.append(statement)
+        return next(self.results, make_result(["uid"], []))
+
+
+def test_bulk_links_stay_under_the_parameter_limit(monkeypatch):
+    book_uids = [uuid.uuid4() for _ in range(300)]
+    tag_uids = [uuid.uuid4() for _ in range(50)] # 15000 links, 30000 parameters in one statement would be too close to 32767
+    bumped = []
+
+    async def bump_versions(uids, session):
+        bumped.extend(uids)
+
+    monkeypatch.setattr(service.book_service, "bump_versions", bump_versions)
+    session = FakeSession([
+        make_result(["book_id"], [(book_uid,) for book_uid in book_uids[:200] * 50]),
+        make_result(["book_id"], [(book_uid,) for book_uid in book_uids[200:] * 50]),
+    ])
+    linked = asyncio.run(TagService().link_tags(session, book_uids, tag_uids))
+
+    assert len(session.statements) == 2
+    assert all(len(statement.compile().params) <= LINK_TAGS_BATCH_SIZE * 2 < 32767 for statement in session.statements)
+    assert linked == 15000 and set(bumped) == set(book_uids)
+    assert all(isinstance(book_uid, uuid.UUID) for book_uid in bumped)
+
+
+def test_bulk_request_size_is_limited():
+    with pytest.raises(ValidationError):
+        TagBulkAddModel(book_uids=[uuid.uuid4() for _ in range(1001)], tags=[{"name": "a"}])
+    with pytest.raises(ValidationError):
+        TagBulkAddModel(book_uids=[uuid.uuid4()], tags=[{"name": str(i)} for i in range(51)])
+
+
+def test_new_tags_show_up_in_the_suggestions():
+    service.tag_suggest_cache.set(("ne", 10), ["cached"])
+    new_uid = uuid.uuid4()
+    # the select finds nothing, the insert creates the tag
+    session = FakeSession([make_result(["uid", "name"], []), make_result(["uid", "name"], [(new_uid, "new")])])
+    assert asyncio.run(TagService().resolve_tags(["new"], session)) == [new_uid]
+    assert service.tag_suggest_cache.get(("ne", 10)) is None
+
+
+def test_existing_tags_keep_the_suggestions():
+    service.tag_suggest_cache.set(("ol", 10), ["cached"])
+    old_uid = uuid.uuid4()
+    session = FakeSession([make_result(["uid", "name"], [(old_uid, "old")])])
+    assert asyncio.run(TagService().resolve_tags(["old"], session)) == [old_uid]
+    assert len(session.statements) == 1
+    assert service.tag_suggest_cache.get(("ol", 10)) == ["cached"]
+    service.tag_suggest_cache.clear()
+
+
+def test_renaming_to_a_taken_name_is_a_409(client, auth_headers, add_books, sync_engine):
+    add_books(1) # adds tag-0 and tag-1
+    with Session(sync_engine) as session:
+        tag = session.exec(select(Tag).where(Tag.name == "tag-1")).one()
+
+    response = client.put(f"/api/v1/tags/{tag.uid}", json={"name": "tag-0"}, headers=auth_headers)
+    assert response.status_code == 409
+    assert response.json()["error_code"] == "tag_exists"
+
+
+@pytest.mark.parametrize("url", ["/api/v1/books/suggest", "/api/v1/tags/suggest"])
+def test_blank_suggest_query_matches_nothing(client, auth_headers, add_books, url):
+    add_books(1)
+    response = client.get(url, params={"q": "   "}, headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json() == []